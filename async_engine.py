@@ -0,0 +1,294 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Thread
+from traceback import print_exc
+
+import protocol
+from protocol import ConnectionClosed
+from compression import Encoder, decode
+from connection import FRAME_HEADER, FileRegion, PendingResponse, Stream, busy_error, encode_frame_header
+
+
+async def read_frame_async(reader):
+    """
+    Same as connection.read_frame, for an asyncio StreamReader.
+
+    Returns None if the other side has closed the connection between two frames.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionClosed('Connection closed in the middle of a header')
+    version, frame_type, flags, request_id, length = FRAME_HEADER.unpack(header)
+    if version != protocol.FRAME_VERSION:
+        raise ConnectionClosed('Unsupported frame version {}'.format(version))
+    if length > protocol.FRAME_MAX_BYTES:
+        raise ConnectionClosed('Frame of {} bytes is too large'.format(length))
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionClosed('Connection closed after {} of {} bytes'.format(len(e.partial), length))
+    return frame_type, flags, request_id, payload
+
+
+class AsyncConnection:
+    """
+    The asyncio counterpart of connection.Connection. Requests are sent from the event loop it was opened on, and responses are handed out through the same thread safe PendingResponse objects. Like it, it asks for compressed responses if opened with `codecs`. Compressed responses are decompressed on `executor`, off the loop.
+    """
+
+    def __init__(self, reader, writer, address, executor):
+        self.address = address
+        self.closed = False
+        # Payload of the 'busy' frame the connection was refused with, if it was
+        self.busy = None
+        self.__loop = asyncio.get_running_loop()
+        self.__reader = reader
+        self.__writer = writer
+        self.__executor = executor
+        self.__write_lock = asyncio.Lock()
+        self.__pending = {}
+        self.__request_ids = count(1)
+        self.__read_task = asyncio.ensure_future(self.__read_responses())
+
+    @classmethod
+    async def open(cls, host, port, executor, codecs=None):
+        address = ':'.join([host, str(port)])
+        try:
+            reader, writer = await asyncio.open_connection(host, int(port))
+            if codecs:
+                body = json.dumps({ 'codecs': codecs }).encode('utf-8')
+                writer.write(encode_frame_header(protocol.FRAME_TYPES['hello'], 0, len(body)))
+                writer.write(body)
+                await writer.drain()
+        except OSError as e:
+            raise ConnectionClosed('Fail to connect to {}: {}'.format(address, e))
+        return cls(reader, writer, address, executor)
+
+    async def submit(self, body, frame_type=protocol.FRAME_TYPES['json']):
+        if self.closed:
+            if self.busy is not None:
+                raise busy_error(self.address, self.busy)
+            raise ConnectionClosed('Connection to {} is closed'.format(self.address))
+        request_id = next(self.__request_ids)
+        pending = self.__pending[request_id] = PendingResponse(self.address, request_id, self.discard, self.cancel)
+        try:
+            async with self.__write_lock:
+                self.__writer.write(encode_frame_header(frame_type, request_id, len(body)))
+                self.__writer.write(body)
+                await self.__writer.drain()
+        except OSError:
+            self.close()
+            raise ConnectionClosed('Fail to send to {}'.format(self.address))
+        return pending
+
+    def discard(self, request_id):
+        # Called from whichever thread gave up waiting
+        self.__loop.call_soon_threadsafe(self.__pending.pop, request_id, None)
+
+    def cancel(self, request_id):
+        self.discard(request_id)
+        asyncio.run_coroutine_threadsafe(self.__send_cancel(request_id), self.__loop)
+
+    async def __send_cancel(self, request_id):
+        try:
+            async with self.__write_lock:
+                self.__writer.write(encode_frame_header(protocol.FRAME_TYPES['cancel'], request_id, 0))
+                await self.__writer.drain()
+        except OSError:
+            self.close()
+
+    async def __read_responses(self):
+        try:
+            while True:
+                frame = await read_frame_async(self.__reader)
+                if frame is None:
+                    break
+                frame_type, flags, request_id, payload = frame
+                if flags >> protocol.FRAME_CODEC_SHIFT:
+                    # Decompressing is CPU work, kept off the loop as compressing is in AsyncEngine.__send_frame
+                    payload = await self.__loop.run_in_executor(self.__executor, decode, flags, payload)
+                if request_id == 0 and frame_type == protocol.FRAME_TYPES['busy']:
+                    self.close(payload)
+                    return
+                if flags & protocol.FRAME_FLAG_MORE:
+                    pending = self.__pending.get(request_id)
+                else:
+                    pending = self.__pending.pop(request_id, None)
+                # The caller may have timed out already, in which case the response is dropped
+                if pending:
+                    pending.put((frame_type, flags, payload))
+        except (OSError, ConnectionClosed):
+            pass
+        self.close()
+
+    def close(self, busy=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.busy = busy
+        for pending in self.__pending.values():
+            pending.put(None if busy is None else (protocol.FRAME_TYPES['busy'], 0, busy))
+        self.__pending.clear()
+        self.__writer.close()
+
+
+class AsyncEngine:
+    """
+    Runs the network side of a node on a single asyncio event loop, in place of one thread per connection and per request.
+
+    Handlers and the COMMANDS dispatch table are shared with the threaded engine through Node._decode_request and Node._process_request. Handlers flagged as 'blocking' in COMMANDS are run on a pool of `request_workers` threads, everything else runs on the loop. Admission control is the same as with the threaded engine: a request without a slot in Node._admission is answered 'busy'. Connections cost no thread here, so they are capped by ASYNC_MAX_CONNECTIONS instead of MAX_CONNECTIONS, and any beyond it are answered 'busy' and closed.
+
+    submit() and request() can be called from any thread. The connections themselves live on the loop, and responses are handed back through PendingResponse.
+    """
+
+    def __init__(self, node):
+        self.__node = node
+        self.__connections = {}
+        self.__connect_locks = {}
+        self.__executor = ThreadPoolExecutor(max_workers=node.request_workers, thread_name_prefix='{}-request'.format(node.name))
+        self.__num_clients = 0
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+
+    def listen(self):
+        asyncio.run_coroutine_threadsafe(self.__serve(), self.__loop).result()
+
+    def submit(self, host, port, body, frame_type=protocol.FRAME_TYPES['json']):
+        return asyncio.run_coroutine_threadsafe(self.__submit(host, port, body, frame_type), self.__loop).result()
+
+    def request(self, host, port, body, frame_type=protocol.FRAME_TYPES['json']):
+        return self.submit(host, port, body, frame_type).get()
+
+    async def __submit(self, host, port, body, frame_type):
+        connection = await self.__get_connection(host, port)
+        try:
+            return await connection.submit(body, frame_type)
+        except ConnectionClosed:
+            # A pooled connection may have been dropped by the other side while it was idle. Retry once on a fresh one.
+            connection = await self.__get_connection(host, port)
+            return await connection.submit(body, frame_type)
+
+    async def __get_connection(self, host, port):
+        key = ':'.join([host, str(port)])
+        connection = self.__connections.get(key)
+        if connection and not connection.closed:
+            return connection
+        lock = self.__connect_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            connection = self.__connections.get(key)
+            if connection is None or connection.closed:
+                connection = await AsyncConnection.open(host, port, self.__executor, self.__node.compression)
+                self.__connections[key] = connection
+        return connection
+
+    async def __serve(self):
+        server = await asyncio.start_server(
+            self.__on_new_client,
+            self.__node.host,
+            self.__node.port,
+            backlog=protocol.LISTEN_BACKLOG,
+        )
+        self.__node._logger.info('Waiting for new connections...')
+        async with server:
+            await server.serve_forever()
+
+    async def __on_new_client(self, reader, writer):
+        if self.__num_clients >= protocol.ASYNC_MAX_CONNECTIONS:
+            self.__node._logger.warning('Too many connections, refusing the one from {}'.format(writer.get_extra_info('peername')))
+            await self.__refuse_client(reader, writer)
+            return
+        self.__num_clients += 1
+        write_lock = asyncio.Lock()
+        # Requests of this connection that are being handled, and whether the client has cancelled them
+        cancelled = {}
+        # Compression codec the client asked for, if any
+        codec = None
+        try:
+            while True:
+                frame = await read_frame_async(reader)
+                if frame is None:
+                    break
+                frame_type, flags, request_id, body = frame
+                if frame_type == protocol.FRAME_TYPES['cancel']:
+                    if request_id in cancelled:
+                        cancelled[request_id] = True
+                    continue
+                if frame_type == protocol.FRAME_TYPES['hello']:
+                    codec = self.__node._decode_hello(body)
+                    continue
+                if not self.__node._admission.acquire(blocking=False):
+                    await self.__send_frame(writer, write_lock, protocol.FRAME_TYPES['busy'], request_id, self.__node._busy_reply)
+                    continue
+                cancelled[request_id] = False
+                asyncio.ensure_future(self.__on_new_request(writer, write_lock, cancelled, codec, request_id, body))
+        except (OSError, ConnectionClosed):
+            pass
+        except Exception as e:
+            print_exc()
+        self.__num_clients -= 1
+        writer.close()
+
+    async def __refuse_client(self, reader, writer):
+        """
+        Same as node.ConnectionReaper: answer 'busy' for request id 0, then close the connection once the client has, or BUSY_LINGER later at the latest
+        """
+        try:
+            await asyncio.wait_for(self.__answer_busy(reader, writer), protocol.BUSY_LINGER)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        writer.close()
+
+    async def __answer_busy(self, reader, writer):
+        writer.write(encode_frame_header(protocol.FRAME_TYPES['busy'], 0, len(self.__node._busy_reply)))
+        writer.write(self.__node._busy_reply)
+        writer.write_eof()
+        await writer.drain()
+        while await reader.read(protocol.BUFF_SIZE):
+            pass
+
+    async def __on_new_request(self, writer, write_lock, cancelled, codec, request_id, body):
+        try:
+            await self.__handle_request(writer, write_lock, cancelled, codec, request_id, body)
+        finally:
+            cancelled.pop(request_id, None)
+            self.__node._admission.release()
+
+    async def __handle_request(self, writer, write_lock, cancelled, codec, request_id, body):
+        action, args = self.__node._decode_request(body)
+        if protocol.COMMANDS.get(action, {}).get('blocking'):
+            frame_type, response = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__node._process_request, action, args)
+        else:
+            frame_type, response = self.__node._process_request(action, args)
+        encoder = Encoder(codec)
+        try:
+            if isinstance(response, Stream):
+                for payload in response:
+                    if cancelled.get(request_id):
+                        break
+                    await self.__send_frame(writer, write_lock, response.frame_type, request_id, payload, protocol.FRAME_FLAG_MORE, encoder)
+                await self.__send_frame(writer, write_lock, response.frame_type, request_id, b'')
+            elif not cancelled.get(request_id):
+                await self.__send_frame(writer, write_lock, frame_type, request_id, response, 0, encoder)
+        except OSError:
+            self.__node._logger.debug('Connection closed before request {} was answered'.format(request_id))
+
+    async def __send_frame(self, writer, write_lock, frame_type, request_id, payload, flags=0, encoder=None):
+        if encoder and encoder.codec:
+            # Compressing is CPU work, kept off the loop
+            payload, flags = await asyncio.get_running_loop().run_in_executor(self.__executor, encoder.encode, payload, flags)
+        async with write_lock:
+            if isinstance(payload, FileRegion):
+                # Opened before anything is written, as in connection.send_frame
+                with payload.open() as file:
+                    writer.write(encode_frame_header(frame_type, request_id, len(payload), flags))
+                    writer.write(payload.prefix)
+                    await asyncio.get_running_loop().sendfile(writer.transport, file, payload.offset, payload.length)
+            else:
+                writer.write(encode_frame_header(frame_type, request_id, len(payload), flags))
+                writer.write(payload)
+            await writer.drain()
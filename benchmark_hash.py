@@ -0,0 +1,34 @@
+import os
+from time import perf_counter
+from argparse import ArgumentParser
+
+import hashing
+
+
+parser = ArgumentParser(description='throughput of every available hash algorithm, hashing data the way a peer scans a file: the digest of every chunk plus the digest of the whole')
+parser.add_argument('-m', '--megabytes', type=int, default=256, help='size of the data to hash, in MiB')
+parser.add_argument('-c', '--bytes_per_chunk', type=int, default=1024 * 1024, help='chunk size, in bytes')
+parser.add_argument('-r', '--rounds', type=int, default=3, help='best of this many rounds is reported')
+args = parser.parse_args()
+
+data = memoryview(os.urandom(args.megabytes * 1024 * 1024))
+
+
+def scan(algorithm):
+    full = hashing.new(algorithm)
+    full.update(data)
+    for offset in range(0, len(data), args.bytes_per_chunk):
+        hashing.hexdigest(algorithm, data[offset:offset + args.bytes_per_chunk])
+
+
+print('{} MiB, {} bytes per chunk'.format(args.megabytes, args.bytes_per_chunk))
+print('{:<10} {:>10}'.format('algorithm', 'MiB/s'))
+for algorithm in hashing.ALGORITHMS:
+    best = None
+    for _ in range(args.rounds):
+        start = perf_counter()
+        scan(algorithm)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # Every byte is hashed twice: once in its chunk and once in the whole file
+    print('{:<10} {:>10.1f}'.format(algorithm, 2 * args.megabytes / best))
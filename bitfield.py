@@ -0,0 +1,86 @@
+class Bitfield:
+    """
+    A set of chunk ids of one file, stored as one bit per chunk. Not thread safe; callers that share one hold their own lock.
+
+    bitfield = Bitfield(10)
+    bitfield.add(3)
+    bitfield.to_bytes() == b'\\x08\\x00'
+    """
+
+    def __init__(self, size, data=None):
+        self.size = size
+        self.__bits = bytearray(data) if data is not None else bytearray((size + 7) // 8)
+        if len(self.__bits) != (size + 7) // 8:
+            raise ValueError('Expected {} bytes for {} bits, got {}'.format((size + 7) // 8, size, len(self.__bits)))
+        self.__count = bin(int.from_bytes(self.__bits, 'little')).count('1')
+
+    @classmethod
+    def from_bytes(cls, size, data):
+        return cls(size, data)
+
+    @classmethod
+    def full(cls, size):
+        data = bytearray(b'\xff' * ((size + 7) // 8))
+        if size & 7:
+            data[-1] = (1 << (size & 7)) - 1
+        return cls(size, data)
+
+    def to_bytes(self):
+        return bytes(self.__bits)
+
+    def copy(self):
+        return Bitfield(self.size, self.__bits)
+
+    def add(self, i):
+        """
+        Set bit i. Returns True if it was not set before.
+        """
+        mask = 1 << (i & 7)
+        if self.__bits[i >> 3] & mask:
+            return False
+        self.__bits[i >> 3] |= mask
+        self.__count += 1
+        return True
+
+    def discard(self, i):
+        mask = 1 << (i & 7)
+        if self.__bits[i >> 3] & mask:
+            self.__bits[i >> 3] &= ~mask & 0xff
+            self.__count -= 1
+
+    def complete(self):
+        return self.__count == self.size
+
+    def missing(self):
+        return [i for i in range(self.size) if i not in self]
+
+    def __contains__(self, i):
+        return 0 <= i < self.size and bool(self.__bits[i >> 3] & (1 << (i & 7)))
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self.__bits):
+            while byte:
+                low = byte & -byte
+                yield (byte_index << 3) + low.bit_length() - 1
+                byte ^= low
+
+    def iter_range(self, first, end):
+        """
+        The set bits from `first` up to `end` (excluded), without going through the bytes before them
+        """
+        first = max(first, 0)
+        end = min(end, self.size)
+        for byte_index in range(first >> 3, (end + 7) >> 3):
+            byte = self.__bits[byte_index]
+            while byte:
+                low = byte & -byte
+                i = (byte_index << 3) + low.bit_length() - 1
+                if first <= i < end:
+                    yield i
+                byte ^= low
+
+    def __len__(self):
+        return self.__count
+
+    def __repr__(self):
+        return 'Bitfield({}/{})'.format(self.__count, self.size)
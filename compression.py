@@ -0,0 +1,95 @@
+import bz2
+import lzma
+import zlib
+
+import protocol
+from protocol import ConnectionClosed
+
+# Codecs a connection can ask responses to be compressed with. 'id' goes in the flags of every compressed frame (see protocol.FRAME_CODEC_SHIFT), so it must never be reused. 'decompressor' makes an object with decompress(data, max_length) and eof, like zlib.decompressobj
+CODECS = {
+    'zlib': {
+        'id': 1,
+        'compress': lambda data: zlib.compress(data, 1),
+        'decompressor': zlib.decompressobj,
+    },
+    'lzma': {
+        'id': 2,
+        'compress': lambda data: lzma.compress(data, preset=0),
+        'decompressor': lzma.LZMADecompressor,
+    },
+    'bz2': {
+        'id': 3,
+        'compress': lambda data: bz2.compress(data, 1),
+        'decompressor': bz2.BZ2Decompressor,
+    },
+}
+
+ID_TO_CODEC = {codec['id']: name for name, codec in CODECS.items()}
+
+
+def parse_codecs(codecs):
+    """
+    Codec names from a list or a comma separated string, keeping only those available here. Example:
+
+    input: 'zlib,snappy'
+    output: ['zlib']
+    """
+    if not codecs:
+        return []
+    if isinstance(codecs, str):
+        codecs = codecs.split(',')
+    return [codec for codec in codecs if codec in CODECS]
+
+
+def choose(offered):
+    """
+    @return the first of the codecs a client offered that is available here, or None
+    """
+    for codec in offered or []:
+        if codec in CODECS:
+            return codec
+    return None
+
+
+class Encoder:
+    """
+    Compresses the frames of one response with `codec` (None for none). A frame is sent compressed only if it is at least COMPRESSION_MIN_BYTES and shrinks below COMPRESSION_MAX_RATIO of its size. After COMPRESSION_GIVE_UP frames in a row did not, the data is taken to be incompressible and the rest of the response is sent as it is without trying.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.__misses = 0
+
+    def encode(self, payload, flags=0):
+        """
+        @return the payload to send (bytes-like or FileRegion) and its flags
+        """
+        if self.codec is None or self.__misses >= protocol.COMPRESSION_GIVE_UP or len(payload) < protocol.COMPRESSION_MIN_BYTES:
+            return payload, flags
+        data = payload.read() if hasattr(payload, 'read') else payload
+        compressed = CODECS[self.codec]['compress'](data)
+        if len(compressed) > len(data) * protocol.COMPRESSION_MAX_RATIO:
+            self.__misses += 1
+            # Whatever was read already is sent from memory rather than read a second time
+            return data, flags
+        self.__misses = 0
+        return compressed, flags | CODECS[self.codec]['id'] << protocol.FRAME_CODEC_SHIFT
+
+
+def decode(flags, payload):
+    """
+    Decompress the payload of a frame if its flags say it is compressed. Raises ConnectionClosed if it cannot be, or if it would be larger than any frame may be.
+    """
+    codec_id = flags >> protocol.FRAME_CODEC_SHIFT
+    if not codec_id:
+        return payload
+    if codec_id not in ID_TO_CODEC:
+        raise ConnectionClosed('Frame compressed with unknown codec {}'.format(codec_id))
+    decompressor = CODECS[ID_TO_CODEC[codec_id]]['decompressor']()
+    try:
+        data = decompressor.decompress(payload, protocol.FRAME_MAX_BYTES)
+    except Exception as e:
+        raise ConnectionClosed('Fail to decompress a frame: {}'.format(e))
+    if not decompressor.eof:
+        raise ConnectionClosed('Compressed frame is truncated or too large')
+    return bytearray(data)
@@ -0,0 +1,449 @@
+import os
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from mmap import mmap, ACCESS_READ
+from queue import Queue, Empty
+from socket import socket, IPPROTO_TCP, TCP_NODELAY
+from struct import Struct
+from threading import Thread, Lock
+
+import protocol
+from protocol import ConnectionClosed, NodeBusy
+from compression import Encoder, decode
+
+
+FRAME_HEADER = Struct(protocol.FRAME_HEADER_FORMAT)
+CHUNK_HEADER = Struct(protocol.CHUNK_HEADER_FORMAT)
+
+
+def is_chunkid(value):
+    """
+    Whether `value`, e.g. from a request of another node, is a chunk id that fits in a chunk header
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 1 << 8 * CHUNK_HEADER.size
+
+
+def encode_frame_header(frame_type, request_id, length, flags=0):
+    """
+    Build the fixed size header that goes in front of every payload. Example:
+
+    input: protocol.FRAME_TYPES['json'], 7, 30
+    output: b'\x01\x01\x00\x00\x00\x00\x00\x07\x00\x00\x00\x1e'
+    """
+    return FRAME_HEADER.pack(protocol.FRAME_VERSION, frame_type, flags, request_id, length)
+
+
+class OpenFiles:
+    """
+    Files opened for reading, by path, shared by any number of threads. At most `limit` of them are kept open: beyond that the least recently used are closed, unless a thread is still reading them.
+
+    with files.open('test_files/f1.txt') as f:
+        os.pread(f.fileno(), 10, 0)
+    """
+
+    def __init__(self, limit):
+        self.__limit = limit
+        self.__files = OrderedDict()
+        self.__lock = Lock()
+
+    @contextmanager
+    def open(self, path):
+        with self.__lock:
+            entry = self.__files.get(path)
+            if entry is None:
+                entry = self.__files[path] = { 'file': open(path, 'rb'), 'users': 0 }
+            self.__files.move_to_end(path)
+            entry['users'] += 1
+            self.__close_unused()
+        try:
+            yield entry['file']
+        finally:
+            with self.__lock:
+                entry['users'] -= 1
+                # Forgotten or pushed out while it was being read
+                if entry['users'] == 0 and self.__files.get(path) is not entry:
+                    entry['file'].close()
+
+    def forget(self, path):
+        """
+        Close the file, or once the threads reading it are done with it. It is opened again if it is asked for again
+        """
+        with self.__lock:
+            entry = self.__files.pop(path, None)
+            if entry and entry['users'] == 0:
+                entry['file'].close()
+
+    def __close_unused(self):
+        excess = len(self.__files) - self.__limit
+        # Least recently used first
+        for path in list(self.__files) if excess > 0 else []:
+            if excess == 0:
+                break
+            if self.__files[path]['users'] == 0:
+                self.__files.pop(path)['file'].close()
+                excess -= 1
+
+
+class FileRegion:
+    """
+    A byte range of a file, used as a frame payload. It is sent straight from the page cache with os.sendfile instead of being read into memory first. The file is opened through `files` when the region is sent, and not before.
+    """
+
+    def __init__(self, files, path, offset, length, prefix=b''):
+        self.files = files
+        self.path = path
+        self.offset = offset
+        self.length = length
+        # Sent as is in front of the region, e.g. a chunk header
+        self.prefix = prefix
+
+    def __len__(self):
+        return len(self.prefix) + self.length
+
+    def open(self):
+        return self.files.open(self.path)
+
+    def read(self):
+        """
+        The prefix and the region as bytes, for when it has to be transformed before it is sent
+        """
+        with self.open() as file:
+            return self.prefix + os.pread(file.fileno(), self.length, self.offset)
+
+
+class Stream:
+    """
+    A response made of any number of frames of the same type, e.g. the chunks of a multi-chunk download. Payloads are produced lazily as the stream is sent.
+    """
+
+    def __init__(self, frame_type, payloads):
+        self.frame_type = frame_type
+        self.payloads = payloads
+
+    def __iter__(self):
+        return iter(self.payloads)
+
+
+def send_file_region(sock, region, file):
+    """
+    Send a region of `file`, the file of the region opened by the caller
+    """
+    if region.prefix:
+        sock.sendall(region.prefix)
+    offset = region.offset
+    remaining = region.length
+    if not hasattr(os, 'sendfile'):
+        with mmap(file.fileno(), 0, access=ACCESS_READ) as m:
+            sock.sendall(memoryview(m)[offset:offset + remaining])
+        return
+    while remaining > 0:
+        # The offset is passed explicitly, so one file object can be shared by any number of threads
+        sent = os.sendfile(sock.fileno(), file.fileno(), offset, remaining)
+        if sent == 0:
+            raise ConnectionClosed('File ended {} bytes before the end of the region'.format(remaining))
+        offset += sent
+        remaining -= sent
+
+
+def send_frame(sock, frame_type, request_id, payload, flags=0):
+    """
+    Send one frame. The payload is either bytes-like or a FileRegion. The caller is responsible for holding the send lock of the socket.
+    """
+    header = encode_frame_header(frame_type, request_id, len(payload), flags)
+    if isinstance(payload, FileRegion):
+        # Opened before anything is sent, so that a file that cannot be opened does not leave half a frame behind
+        with payload.open() as file:
+            sock.sendall(header)
+            send_file_region(sock, payload, file)
+        return
+    # Small payloads are copied behind the header so that the frame goes out in one segment. Large ones are sent as they are to avoid the copy.
+    if len(payload) <= protocol.BUFF_SIZE:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def send_response(sock, send_lock, frame_type, request_id, response, cancelled=None, codec=None):
+    """
+    Send a response, which is either one payload or a Stream. The frames of a stream are sent one at a time, so responses to other requests on the same connection go out between them.
+
+    `cancelled` is a dict of request id to whether the client has cancelled that request. A cancelled stream is cut short, a cancelled single response is not sent.
+
+    `codec` is the compression codec the client asked for in its hello frame, or None. Frames worth compressing are compressed with it (see compression.Encoder), outside of the send lock.
+    """
+    encoder = Encoder(codec)
+    if not isinstance(response, Stream):
+        if cancelled and cancelled.get(request_id):
+            return
+        payload, flags = encoder.encode(response)
+        with send_lock:
+            send_frame(sock, frame_type, request_id, payload, flags)
+        return
+    for payload in response:
+        if cancelled and cancelled.get(request_id):
+            break
+        payload, flags = encoder.encode(payload, protocol.FRAME_FLAG_MORE)
+        with send_lock:
+            send_frame(sock, response.frame_type, request_id, payload, flags)
+    with send_lock:
+        send_frame(sock, response.frame_type, request_id, b'')
+
+
+def recv_exact(sock, length):
+    """
+    Read exactly `length` bytes into a preallocated buffer and returns it (bytearray). Raises ConnectionClosed if the socket is closed before that.
+    """
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionClosed('Connection closed after {} of {} bytes'.format(received, length))
+        received += n
+    return data
+
+
+def read_frame(sock):
+    """
+    Read one frame and returns its type (int), flags (int), request id (int) and payload (bytearray), as it came over the wire. A compressed payload is decompressed by compression.decode.
+
+    Returns None if the other side has closed the connection between two frames.
+    """
+    header = bytearray(FRAME_HEADER.size)
+    n = sock.recv_into(header)
+    if n == 0:
+        return None
+    if n < FRAME_HEADER.size:
+        header[n:] = recv_exact(sock, FRAME_HEADER.size - n)
+    version, frame_type, flags, request_id, length = FRAME_HEADER.unpack(header)
+    if version != protocol.FRAME_VERSION:
+        raise ConnectionClosed('Unsupported frame version {}'.format(version))
+    if length > protocol.FRAME_MAX_BYTES:
+        raise ConnectionClosed('Frame of {} bytes is too large'.format(length))
+    return frame_type, flags, request_id, recv_exact(sock, length)
+
+
+def busy_error(address, payload):
+    """
+    The NodeBusy to raise for a 'busy' frame received from `address`
+    """
+    return NodeBusy('{} is busy'.format(address), json.loads(payload.decode('utf-8'))['retry_after'])
+
+
+class PendingResponse:
+    """
+    The response to one request sent with submit(), filled in by the reader of the connection as frames arrive. It is either a single frame (get) or a stream of frames (stream). Both raise NodeBusy if the other side had no room for the request.
+    """
+
+    def __init__(self, address, request_id, discard, cancel):
+        self.address = address
+        self.request_id = request_id
+        self.__discard = discard
+        self.__cancel = cancel
+        self.__frames = Queue()
+        self.cancelled = False
+
+    def put(self, frame):
+        """
+        Called by the reader with (frame_type, flags, payload), or with None if the connection is closed
+        """
+        self.__frames.put(frame)
+
+    def __next_frame(self, timeout):
+        try:
+            frame = self.__frames.get(timeout=timeout)
+        except Empty:
+            self.__discard(self.request_id)
+            raise ConnectionClosed('Request {} to {} timed out'.format(self.request_id, self.address))
+        if frame is None:
+            if self.cancelled:
+                raise ConnectionClosed('Request {} to {} was cancelled'.format(self.request_id, self.address))
+            raise ConnectionClosed('Connection to {} closed before the response arrived'.format(self.address))
+        frame_type, flags, payload = frame
+        if frame_type == protocol.FRAME_TYPES['busy']:
+            raise busy_error(self.address, payload)
+        return frame
+
+    def get(self, timeout=protocol.REQUEST_TIMEOUT):
+        frame_type, flags, payload = self.__next_frame(timeout)
+        return payload
+
+    def cancel(self):
+        """
+        Tell the other side to stop answering this request. Whatever still arrives for it is dropped, and a thread waiting on it gets ConnectionClosed.
+        """
+        self.cancelled = True
+        self.__cancel(self.request_id)
+        self.__frames.put(None)
+
+    def stream(self, timeout=protocol.REQUEST_TIMEOUT):
+        """
+        Yield the payload of every frame of a streamed response. `timeout` applies to each frame.
+        """
+        while True:
+            frame_type, flags, payload = self.__next_frame(timeout)
+            if not flags & protocol.FRAME_FLAG_MORE:
+                return
+            yield payload
+
+
+class Connection:
+    """
+    A long-lived connection to another node. Any number of threads can send requests at the same time. Each request is tagged with a request id, and a reader thread hands every response frame to the PendingResponse of that id.
+
+    With `codecs`, the connection starts with a hello frame asking for responses compressed with one of them. Compressed responses are decompressed by the reader, so callers always get them as they were before compression.
+
+    A node with no room for the connection itself answers 'busy' for request id 0 and closes it. Every request on it then raises NodeBusy.
+    """
+
+    def __init__(self, host, port, codecs=None):
+        self.address = ':'.join([host, str(port)])
+        self.closed = False
+        # Payload of the 'busy' frame the connection was refused with, if it was
+        self.busy = None
+        self.__sock = socket()
+        self.__sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        try:
+            self.__sock.connect((host, int(port)))
+        except OSError as e:
+            self.__sock.close()
+            raise ConnectionClosed('Fail to connect to {}: {}'.format(self.address, e))
+        self.__send_lock = Lock()
+        self.__pending = {}
+        self.__pending_lock = Lock()
+        self.__request_ids = count(1)
+        if codecs:
+            try:
+                send_frame(self.__sock, protocol.FRAME_TYPES['hello'], 0, json.dumps({ 'codecs': codecs }).encode('utf-8'))
+            except OSError as e:
+                self.__sock.close()
+                raise ConnectionClosed('Fail to send to {}: {}'.format(self.address, e))
+        self.__reader = Thread(target=self.__read_responses, daemon=True)
+        self.__reader.start()
+
+    def submit(self, body, frame_type=protocol.FRAME_TYPES['json']):
+        """
+        Send a request without waiting for its response. Returns a PendingResponse.
+        """
+        with self.__pending_lock:
+            if self.closed:
+                if self.busy is not None:
+                    raise busy_error(self.address, self.busy)
+                raise ConnectionClosed('Connection to {} is closed'.format(self.address))
+            request_id = next(self.__request_ids)
+            pending = self.__pending[request_id] = PendingResponse(self.address, request_id, self.discard, self.cancel)
+        try:
+            with self.__send_lock:
+                send_frame(self.__sock, frame_type, request_id, body)
+        except OSError:
+            self.close()
+            raise ConnectionClosed('Fail to send to {}'.format(self.address))
+        return pending
+
+    def request(self, body, frame_type=protocol.FRAME_TYPES['json'], timeout=protocol.REQUEST_TIMEOUT):
+        return self.submit(body, frame_type).get(timeout)
+
+    def discard(self, request_id):
+        """
+        Stop waiting for the response to a request. Frames that still arrive for it are dropped.
+        """
+        with self.__pending_lock:
+            self.__pending.pop(request_id, None)
+
+    def cancel(self, request_id):
+        self.discard(request_id)
+        try:
+            with self.__send_lock:
+                send_frame(self.__sock, protocol.FRAME_TYPES['cancel'], request_id, b'')
+        except OSError:
+            self.close()
+
+    def __read_responses(self):
+        try:
+            while True:
+                frame = read_frame(self.__sock)
+                if frame is None:
+                    break
+                frame_type, flags, request_id, payload = frame
+                payload = decode(flags, payload)
+                if request_id == 0 and frame_type == protocol.FRAME_TYPES['busy']:
+                    self.close(payload)
+                    return
+                with self.__pending_lock:
+                    pending = self.__pending.get(request_id)
+                    if not flags & protocol.FRAME_FLAG_MORE:
+                        self.__pending.pop(request_id, None)
+                # The caller may have timed out already, in which case the response is dropped
+                if pending:
+                    pending.put((frame_type, flags, payload))
+        except (OSError, ConnectionClosed):
+            pass
+        self.close()
+
+    def close(self, busy=None):
+        """
+        With `busy`, the payload of the 'busy' frame the other side refused the connection with, the requests waiting on it raise NodeBusy instead of ConnectionClosed
+        """
+        with self.__pending_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.busy = busy
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+        for response in pending:
+            response.put(None if busy is None else (protocol.FRAME_TYPES['busy'], 0, busy))
+        try:
+            self.__sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Keeps one Connection per remote 'host:port' and reopens it when it has been closed. New connections ask for `codecs`.
+    """
+
+    def __init__(self, codecs=None):
+        self.__codecs = codecs
+        self.__connections = {}
+        self.__lock = Lock()
+
+    def get(self, host, port):
+        key = ':'.join([host, str(port)])
+        with self.__lock:
+            connection = self.__connections.get(key)
+        if connection and not connection.closed:
+            return connection
+
+        # Connect outside of the lock so that one slow peer does not block requests to everyone else
+        new_connection = Connection(host, port, self.__codecs)
+        with self.__lock:
+            connection = self.__connections.get(key)
+            if connection and not connection.closed:
+                new_connection.close()
+                return connection
+            self.__connections[key] = new_connection
+        return new_connection
+
+    def submit(self, host, port, body, frame_type=protocol.FRAME_TYPES['json']):
+        connection = self.get(host, port)
+        try:
+            return connection.submit(body, frame_type)
+        except ConnectionClosed:
+            # A pooled connection may have been dropped by the other side while it was idle. Retry once on a fresh one.
+            return self.get(host, port).submit(body, frame_type)
+
+    def request(self, host, port, body, frame_type=protocol.FRAME_TYPES['json']):
+        return self.submit(host, port, body, frame_type).get()
+
+    def close_all(self):
+        with self.__lock:
+            connections = list(self.__connections.values())
+            self.__connections.clear()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,293 @@
+import os
+import json
+from os.path import dirname, exists, getsize
+from threading import Condition, Lock
+
+import merkle
+import hashing
+from bitfield import Bitfield
+
+
+class Download:
+    """
+    One file being downloaded. The destination file is preallocated to its final size and every verified chunk is written in place with os.pwrite, so no chunk is ever copied a second time.
+
+    `have` records which chunks are on disk. The digest of the whole file, with the hash `algorithm` the file was registered with, is computed while chunks arrive: whenever the chunk right after the hashed prefix is written, the prefix is extended, so by the end of an in-order download the file has been hashed without being read back.
+
+    With a `merkle_root`, the tracker has no chunk md5s for the file. Every chunk arrives with its proof and is checked against the root instead (see check_chunk), and the chunks are not hashed as a whole: once every chunk has been checked, the file has been.
+
+    A download can be resumed. With a `state_path`, `have` is saved there by save_state(), and a destination file of the right size is opened as it is: the chunks the saved state lists are trusted, or without a state every chunk on disk is checked against its md5. Only what is still missing needs to be downloaded.
+
+    `failed` is set once a chunk cannot be had from any of its holders.
+
+    Requests in flight are tracked per chunk, so that near the end of the download the last chunks can be asked from several holders at once (see pick_endgame_chunk).
+
+    self.__requests = {
+        5: {
+            '127.0.0.1:3029': (PendingResponse(...), False),   # part of a range request, cancelled only once the file is complete
+            '127.0.0.1:3030': (PendingResponse(...), True),    # endgame duplicate, for this chunk alone
+        }
+    }
+    """
+
+    def __init__(self, filename, destination, file_bytes, bytes_per_chunk, file_md5, chunkid_to_md5, chunkid_to_addresses=None, state_path=None, merkle_root=None, algorithm=hashing.DEFAULT_ALGORITHM):
+        self.filename = filename
+        self.destination = destination
+        self.bytes = file_bytes
+        self.bytes_per_chunk = bytes_per_chunk
+        self.md5 = file_md5
+        self.chunkid_to_md5 = chunkid_to_md5
+        self.chunkid_to_addresses = chunkid_to_addresses if chunkid_to_addresses is not None else {}
+        self.num_chunks = (file_bytes + bytes_per_chunk - 1) // bytes_per_chunk
+        self.have = Bitfield(self.num_chunks)
+        self.state_path = state_path
+        self.algorithm = algorithm
+        self.merkle_root = bytes.fromhex(merkle_root) if merkle_root else None
+        # Leaf hash and proof of every chunk checked against the Merkle root, so that the chunk can be served along with its proof
+        self.__leaves = {}
+        self.__proofs = {}
+        self.__tree = None
+        self.__requests = {}
+        self.__lock = Lock()
+        # Threads writing chunks right now. close() waits for them, so that no chunk is written to a closed, or reused, file descriptor
+        self.__writers = 0
+        self.__no_writers = Condition(self.__lock)
+        self.__closed = False
+        self.failed = False
+        self.__md5_full = hashing.new(algorithm)
+        self.__num_hashed_chunks = 0
+
+        if dirname(destination):
+            os.makedirs(dirname(destination), exist_ok=True)
+        if state_path and exists(destination) and getsize(destination) == file_bytes:
+            self.__fd = os.open(destination, os.O_RDWR)
+            self.__resume()
+            return
+        self.__fd = os.open(destination, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.__fd, file_bytes)
+        if hasattr(os, 'posix_fallocate') and file_bytes:
+            try:
+                os.posix_fallocate(self.__fd, 0, file_bytes)
+            except OSError:
+                # Not every file system can reserve blocks up front. The file already has its final size either way
+                pass
+
+    def chunk_range(self, chunkid):
+        offset = chunkid * self.bytes_per_chunk
+        return offset, min(self.bytes_per_chunk, self.bytes - offset)
+
+    def write_chunk(self, chunkid, data):
+        """
+        Write a verified chunk at its offset in the destination file. Any number of threads can write at the same time, and the download can be closed while they do: chunks that arrive after that are not written.
+
+        @return True if this chunk was not written before
+        """
+        offset, length = self.chunk_range(chunkid)
+        if len(data) != length:
+            raise ValueError('Chunk {} should be {} bytes, got {}'.format(chunkid, length, len(data)))
+        with self.__lock:
+            if self.__closed or chunkid in self.have:
+                return False
+            self.__writers += 1
+        try:
+            view = memoryview(data)
+            written = 0
+            while written < length:
+                written += os.pwrite(self.__fd, view[written:], offset + written)
+            with self.__lock:
+                if not self.have.add(chunkid):
+                    return False
+                if self.merkle_root is None and chunkid == self.__num_hashed_chunks:
+                    self.__md5_full.update(view)
+                    self.__num_hashed_chunks += 1
+                    self.__hash_written_prefix()
+            return True
+        finally:
+            with self.__lock:
+                self.__writers -= 1
+                if not self.__writers:
+                    self.__no_writers.notify_all()
+
+    def check_chunk(self, chunkid, data, proof=None):
+        """
+        Check a chunk against its md5, or against the Merkle root with `proof` (a list of sibling hashes)
+        """
+        if self.merkle_root is None:
+            return hashing.hexdigest(self.algorithm, data) == self.chunkid_to_md5.get(chunkid)
+        leaf = merkle.hash_leaf(data, self.algorithm)
+        if not merkle.verify(self.merkle_root, chunkid, self.num_chunks, leaf, proof or [], self.algorithm):
+            return False
+        with self.__lock:
+            self.__leaves[chunkid] = leaf
+            self.__proofs[chunkid] = proof
+        return True
+
+    def proof(self, chunkid):
+        """
+        @return the proof a chunk arrived with, or None
+        """
+        with self.__lock:
+            return self.__proofs.get(chunkid)
+
+    def tree(self):
+        """
+        The whole Merkle tree of a complete download. Chunks that were not checked by this process, i.e. were there when the download was resumed, are read back to hash them.
+        """
+        if self.__tree is not None:
+            return self.__tree
+        leaves = []
+        for chunkid in range(self.num_chunks):
+            with self.__lock:
+                leaf = self.__leaves.get(chunkid)
+            if leaf is None:
+                offset, length = self.chunk_range(chunkid)
+                leaf = merkle.hash_leaf(os.pread(self.__fd, length, offset), self.algorithm)
+            leaves.append(leaf)
+        self.__tree = merkle.MerkleTree(leaves, self.algorithm)
+        return self.__tree
+
+    def has_chunk(self, chunkid):
+        with self.__lock:
+            return chunkid in self.have
+
+    def complete(self):
+        with self.__lock:
+            return self.have.complete()
+
+    def start_request(self, chunkid, address, pending, alone=False):
+        """
+        Record a request for a chunk sent to `address`. `alone` tells that the request is for this chunk only, so it can be cancelled as soon as another copy of the chunk is written.
+
+        @return False if the chunk is already written or already requested from `address`
+        """
+        with self.__lock:
+            if chunkid in self.have:
+                return False
+            requests = self.__requests.setdefault(chunkid, {})
+            if address in requests:
+                return False
+            requests[address] = (pending, alone)
+            return True
+
+    def end_request(self, chunkid, address):
+        with self.__lock:
+            requests = self.__requests.get(chunkid)
+            if requests is not None:
+                requests.pop(address, None)
+                if not requests:
+                    del self.__requests[chunkid]
+
+    def cancel_requests(self, chunkid):
+        """
+        Take the requests that are no longer needed once a chunk has been written: those for this chunk alone, or every request still in flight if the whole file is written. Range requests stay recorded until their worker ends them.
+
+        @return the PendingResponse of those requests
+        """
+        pendings = []
+        with self.__lock:
+            if self.have.complete():
+                requests = [request for requests in self.__requests.values() for request in requests.values()]
+                self.__requests.clear()
+            else:
+                in_flight = self.__requests.get(chunkid, {})
+                requests = [in_flight.pop(address) for address, (pending, alone) in list(in_flight.items()) if alone]
+                if chunkid in self.__requests and not in_flight:
+                    del self.__requests[chunkid]
+        for pending, alone in requests:
+            if pending is not None and pending not in pendings:
+                pendings.append(pending)
+        return pendings
+
+    def pick_endgame_chunk(self, threshold, max_duplicates):
+        """
+        Once fewer than `threshold` chunks are missing, pick the chunk in flight with the fewest requests that another holder could also be asked for.
+
+        @return (chunkid, addresses not asked yet), or None if there is nothing to duplicate
+        """
+        with self.__lock:
+            if self.num_chunks - len(self.have) >= threshold:
+                return None
+            best = None
+            for chunkid, requests in self.__requests.items():
+                if chunkid in self.have or len(requests) > max_duplicates:
+                    continue
+                if best is not None and len(requests) >= len(self.__requests[best[0]]):
+                    continue
+                candidates = [address for address in list(self.chunkid_to_addresses.get(chunkid, ())) if address not in requests]
+                if candidates:
+                    best = (chunkid, candidates)
+            return best
+
+    def verify(self):
+        """
+        Finish hashing whatever chunks arrived out of order and compare with the md5 of the file. With a Merkle root, compare the root of the tree over the chunks with it instead, which only reads back chunks that were not checked on arrival.
+        """
+        if self.merkle_root is not None:
+            return self.complete() and self.tree().root == self.merkle_root
+        with self.__lock:
+            self.__hash_written_prefix()
+            if self.__num_hashed_chunks < self.num_chunks:
+                return False
+            return self.__md5_full.hexdigest() == self.md5
+
+    def __hash_written_prefix(self):
+        while self.__num_hashed_chunks in self.have:
+            offset, length = self.chunk_range(self.__num_hashed_chunks)
+            self.__md5_full.update(os.pread(self.__fd, length, offset))
+            self.__num_hashed_chunks += 1
+
+    def save_state(self):
+        """
+        Save which chunks are on disk, so that the download can be resumed after this process dies
+        """
+        if not self.state_path:
+            return
+        with self.__lock:
+            have = self.have.to_bytes()
+        state = {
+            'destination': self.destination,
+            'bytes': self.bytes,
+            'bytes_per_chunk': self.bytes_per_chunk,
+            'md5': self.md5,
+            'have': have.hex(),
+        }
+        os.makedirs(dirname(self.state_path), exist_ok=True)
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def remove_state(self):
+        if self.state_path and exists(self.state_path):
+            os.remove(self.state_path)
+
+    def __resume(self):
+        have = self.__load_state()
+        if have is None:
+            # Nothing says which chunks are good. Check each of them against its md5, if there is one
+            have = Bitfield(self.num_chunks)
+            for chunkid in range(self.num_chunks if self.merkle_root is None else 0):
+                offset, length = self.chunk_range(chunkid)
+                if hashing.hexdigest(self.algorithm, os.pread(self.__fd, length, offset)) == self.chunkid_to_md5.get(chunkid):
+                    have.add(chunkid)
+        self.have = have
+
+    def __load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if (state['bytes'], state['bytes_per_chunk'], state['md5']) != (self.bytes, self.bytes_per_chunk, self.md5):
+                return None
+            return Bitfield.from_bytes(self.num_chunks, bytes.fromhex(state['have']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            self.__no_writers.wait_for(lambda: not self.__writers)
+        os.close(self.__fd)
+
+    def remove(self):
+        self.close()
+        os.remove(self.destination)
+        self.remove_state()
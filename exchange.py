@@ -0,0 +1,161 @@
+import random
+from collections import deque
+from threading import Condition, Lock
+
+import protocol
+from bitfield import Bitfield
+
+
+class HaveLog:
+    """
+    Which chunks of one file this peer has, as told to other peers by 'have': the Bitfield of the chunks written so far (None once the whole file is here), and every chunk added since the log was made, numbered by version. Other peers ask for the whole bitmap once and then for what was added since the version they know, as the tracker does with 'loc_delta'. Thread safe.
+
+    log = HaveLog(10, have)
+    log.add(3)
+    log.changes(0) == (1, [3])
+    """
+
+    def __init__(self, num_chunks, have=None):
+        self.num_chunks = num_chunks
+        self.have = have
+        self.version = 0
+        self.closed = False
+        # Peers that asked about the file, and so hold chunks of it or soon will
+        self.__peers = {}
+        self.__changes = deque(maxlen=protocol.PEER_HAVE_LOG_LENGTH)
+        self.__changed = Condition()
+
+    def add(self, chunkid):
+        with self.__changed:
+            self.version += 1
+            self.__changes.append(chunkid)
+            self.__changed.notify_all()
+
+    def learn(self, address):
+        with self.__changed:
+            self.__peers[address] = True
+
+    def known(self, limit):
+        """
+        @return up to `limit` of the peers that asked about the file, picked at random
+        """
+        with self.__changed:
+            addresses = list(self.__peers)
+        return random.sample(addresses, min(limit, len(addresses)))
+
+    def close(self):
+        """
+        The file is not shared anymore. Peers waiting for changes are answered right away
+        """
+        with self.__changed:
+            self.closed = True
+            self.__changed.notify_all()
+
+    def bitmap(self):
+        """
+        @return the current version and the bitmap of the chunks as of that version
+        """
+        with self.__changed:
+            have = self.have if self.have is not None else Bitfield.full(self.num_chunks)
+            return self.version, have.to_bytes()
+
+    def changes(self, since, timeout=0):
+        """
+        The chunks added after version `since`, oldest first. If none were yet, wait up to `timeout` seconds for one.
+
+        @return the current version and the chunks, or None if the log does not go back to `since` or the file is not shared anymore
+        """
+        with self.__changed:
+            if timeout > 0 and self.version == since:
+                self.__changed.wait_for(lambda: self.closed or self.version != since, timeout)
+            num_changes = self.version - since
+            if self.closed or num_changes < 0 or num_changes > len(self.__changes):
+                return None
+            return self.version, list(self.__changes)[len(self.__changes) - num_changes:]
+
+
+class SwarmExchange:
+    """
+    The other peers a download exchanges have-bitmaps with, up to PEER_EXCHANGE_PARTNERS at a time, and the peers known to hold chunks of the file to pick new partners from. Peers are learnt from the tracker when the download starts, then from the partners themselves and from the peers that ask this one. Thread safe.
+
+    `start` is called with the address of every new partner and returns the thread that keeps exchanging with it, which is stopped when the partner is dropped.
+
+    self.__partners = {
+        '127.0.0.1:3030': {
+            'version': 12,      # version of the HaveLog of the partner that the download is up to date with. None until its bitmap was received
+            'poller': <Poller>,
+        }
+    }
+    """
+
+    def __init__(self, own_address, start):
+        self.__own_address = own_address
+        self.__start = start
+        self.__known = {}
+        self.__partners = {}
+        self.__failed = set()
+        self.__stopped = False
+        self.__lock = Lock()
+
+    def learn(self, addresses):
+        with self.__lock:
+            for address in addresses:
+                if address != self.__own_address and address not in self.__failed:
+                    self.__known[address] = True
+
+    def known(self, limit):
+        """
+        @return up to `limit` of the known peers, picked at random
+        """
+        with self.__lock:
+            addresses = list(self.__known)
+        return random.sample(addresses, min(limit, len(addresses)))
+
+    def refill(self):
+        """
+        Start exchanging with known peers until there are PEER_EXCHANGE_PARTNERS partners, or no peer is left to pick
+        """
+        with self.__lock:
+            if self.__stopped:
+                return
+            candidates = [address for address in self.__known if address not in self.__partners]
+            random.shuffle(candidates)
+            new_partners = candidates[:max(0, protocol.PEER_EXCHANGE_PARTNERS - len(self.__partners))]
+            for address in new_partners:
+                self.__partners[address] = { 'version': None, 'poller': None }
+        for address in new_partners:
+            poller = self.__start(address)
+            with self.__lock:
+                if address in self.__partners:
+                    self.__partners[address]['poller'] = poller
+                    continue
+            # Dropped while it was being started
+            poller.shutdown_flag.set()
+
+    def state(self, address):
+        with self.__lock:
+            return self.__partners.get(address)
+
+    def drop(self, address):
+        """
+        Stop exchanging with a partner that failed, never pick it again, and pick another one
+        """
+        with self.__lock:
+            partner = self.__partners.pop(address, None)
+            self.__known.pop(address, None)
+            self.__failed.add(address)
+        if partner and partner['poller']:
+            partner['poller'].shutdown_flag.set()
+        self.refill()
+
+    def stop(self):
+        with self.__lock:
+            self.__stopped = True
+            partners, self.__partners = self.__partners, {}
+        for partner in partners.values():
+            if partner['poller']:
+                partner['poller'].shutdown_flag.set()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__partners)
@@ -0,0 +1,64 @@
+import hashlib
+
+# Every algorithm gives digests of this size, so chunk digests pack into the tracker and into Merkle trees the same way whichever one a file uses
+DIGEST_BYTES = 16
+DEFAULT_ALGORITHM = 'md5'
+
+# Algorithm names as they appear in the 'hash' of a file, each with a constructor like hashlib.md5
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'blake2b': lambda data=b'': hashlib.blake2b(data, digest_size=DIGEST_BYTES),
+    'blake2s': lambda data=b'': hashlib.blake2s(data, digest_size=DIGEST_BYTES),
+}
+
+# How the tracker stores the algorithm of a file on disk. Never reuse an id
+ALGORITHM_IDS = {
+    'md5': 0,
+    'blake2b': 1,
+    'blake2s': 2,
+    'xxh3_128': 3,
+    'blake3': 4,
+}
+
+try:
+    import xxhash
+    ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+try:
+    import blake3
+
+    class Blake3:
+        """
+        blake3 truncated to DIGEST_BYTES, with the interface of hashlib objects
+        """
+
+        def __init__(self, data=b''):
+            self.__hash = blake3.blake3(data)
+
+        def update(self, data):
+            self.__hash.update(data)
+
+        def digest(self):
+            return self.__hash.digest(length=DIGEST_BYTES)
+
+        def hexdigest(self):
+            return self.digest().hex()
+
+    ALGORITHMS['blake3'] = Blake3
+except ImportError:
+    pass
+
+
+def new(algorithm, data=b''):
+    """
+    @return a hash object of `algorithm`, fed with `data`
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown hash algorithm {}'.format(algorithm))
+    return ALGORITHMS[algorithm](data)
+
+
+def hexdigest(algorithm, data):
+    return new(algorithm, data).hexdigest()
@@ -15,7 +15,8 @@ with open(args.command_file, 'r') as f:
 server = Server(
     host=config['server']['parameters']['host'],
     port=config['server']['parameters']['port'],
-    dynamic_port_range= config['server']['parameters']['dynamic_port_range']
+    dynamic_port_range= config['server']['parameters']['dynamic_port_range'],
+    engine=config['server']['parameters'].get('engine'),
 )
 thread_server = Thread(target=server.run)
 
@@ -31,6 +32,8 @@ for peer_config in config['peers']:
         dynamic_port_range=parameters['dynamic_port_range'],
         num_download_threads=parameters['num_download_threads'],
         name=parameters['name'],
+        engine=parameters.get('engine'),
+        compression=parameters.get('compression'),
     )
     thread_peers.append(Thread(target=peer.run, kwargs={
         'auto_mode': True,
@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+from os.path import join, abspath
+
+import hashing
+
+
+class Manifest:
+    """
+    Remembers the md5s computed for local files, so that registering a file again does not read it again.
+
+    Every file has one entry in `directory`, named after the hash of its absolute path. An entry is only used while the file has the same size, mtime and inode as when it was hashed, and the same chunk size and hash algorithm are asked for. The 'md5' fields hold digests of that algorithm.
+
+    {
+        'path': '/home/me/test_files/1392bytes.txt',
+        'bytes': 1392,
+        'mtime_ns': 1538432512000000000,
+        'inode': 2883641,
+        'device': 2049,
+        'bytes_per_chunk': 1024,
+        'hash': 'md5',
+        'md5_full': 'e22428ccf96cda9674a939c209ad1000',
+        'md5_chunks': ['03c7c0ace395d80182db07ae2c30f034', '4b43b0aee35624cd95b910189b3dc231']
+    }
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, filepath, bytes_per_chunk, algorithm=hashing.DEFAULT_ALGORITHM):
+        """
+        @return the entry of the file, or None if it is unknown, has changed since, or was split into chunks of another size or hashed with another algorithm
+        """
+        try:
+            with open(self.__entry_path(filepath)) as f:
+                entry = json.load(f)
+            stat = os.stat(filepath)
+        except (OSError, ValueError):
+            return None
+        if entry.get('path') != abspath(filepath) or entry.get('bytes_per_chunk') != bytes_per_chunk or not self.__matches(entry, stat):
+            return None
+        # Entries written before files could be hashed with anything else are md5
+        if entry.get('hash', hashing.DEFAULT_ALGORITHM) != algorithm:
+            return None
+        return entry
+
+    def put(self, filepath, stat, bytes_per_chunk, md5_full, md5_chunks, algorithm=hashing.DEFAULT_ALGORITHM):
+        """
+        Save the md5s of a file. `stat` is the os.stat of the file taken before it was read; nothing is saved if the file has changed since.
+        """
+        try:
+            if not self.__matches(self.__signature(stat), os.stat(filepath)):
+                return
+        except OSError:
+            return
+        entry = self.__signature(stat)
+        entry.update({
+            'path': abspath(filepath),
+            'bytes_per_chunk': bytes_per_chunk,
+            'hash': algorithm,
+            'md5_full': md5_full,
+            'md5_chunks': md5_chunks,
+        })
+        path = self.__entry_path(filepath)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            # The manifest only saves time. Failing to write it costs a rescan next time
+            pass
+
+    def remove(self, filepath):
+        try:
+            os.remove(self.__entry_path(filepath))
+        except OSError:
+            pass
+
+    def __entry_path(self, filepath):
+        return join(self.directory, hashlib.sha1(abspath(filepath).encode('utf-8')).hexdigest() + '.json')
+
+    @staticmethod
+    def __signature(stat):
+        return {
+            'bytes': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+            'device': stat.st_dev,
+        }
+
+    @classmethod
+    def __matches(cls, entry, stat):
+        signature = cls.__signature(stat)
+        return all(entry.get(key) == value for key, value in signature.items())
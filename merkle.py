@@ -0,0 +1,89 @@
+from struct import Struct
+
+import hashing
+
+# Number of hashes in a proof, in front of them in a chunk frame
+PROOF_HEADER = Struct('!B')
+HASH_BYTES = hashing.DIGEST_BYTES
+
+
+def hash_leaf(data, algorithm=hashing.DEFAULT_ALGORITHM):
+    """
+    A leaf of the tree is the digest of a chunk, the same digest chunks are checked with otherwise
+    """
+    return hashing.new(algorithm, data).digest()
+
+
+def hash_node(left, right, algorithm=hashing.DEFAULT_ALGORITHM):
+    # The prefix keeps an inner node from ever being taken for a leaf
+    return hashing.new(algorithm, b'\x01' + left + right).digest()
+
+
+class MerkleTree:
+    """
+    Hash tree over the chunks of a file. Each level pairs up the hashes of the level below; an odd hash at the end of a level moves up unchanged. The root stands for the whole file, so the tracker only needs to keep that one hash, and any chunk can be checked against it with its proof: the sibling hashes on the way from its leaf to the root.
+
+    tree = MerkleTree([hash_leaf(chunk) for chunk in chunks])
+    verify(tree.root, 5, len(chunks), hash_leaf(chunks[5]), tree.proof(5)) == True
+    """
+
+    def __init__(self, leaves, algorithm=hashing.DEFAULT_ALGORITHM):
+        self.num_leaves = len(leaves)
+        self.algorithm = algorithm
+        self.levels = [list(leaves)]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            self.levels.append([hash_node(level[i], level[i + 1], algorithm) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)])
+
+    @property
+    def root(self):
+        return self.levels[-1][0] if self.levels[-1] else hash_leaf(b'', self.algorithm)
+
+    def leaf(self, index):
+        return self.levels[0][index]
+
+    def proof(self, index):
+        """
+        @return the sibling hashes from the leaf up, leaving out levels where the node has no sibling
+        """
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                proof.append(level[sibling])
+            index //= 2
+        return proof
+
+
+def verify(root, index, num_leaves, leaf, proof, algorithm=hashing.DEFAULT_ALGORITHM):
+    """
+    Check that `leaf` is leaf number `index` of the tree of `num_leaves` leaves whose root is `root`
+    """
+    node = leaf
+    width = num_leaves
+    proof = iter(proof)
+    while width > 1:
+        sibling = index ^ 1
+        if sibling < width:
+            try:
+                other = next(proof)
+            except StopIteration:
+                return False
+            node = hash_node(other, node, algorithm) if index & 1 else hash_node(node, other, algorithm)
+        index //= 2
+        width = (width + 1) // 2
+    return node == root and next(proof, None) is None
+
+
+def pack_proof(proof):
+    return PROOF_HEADER.pack(len(proof)) + b''.join(proof)
+
+
+def unpack_proof(data, offset=0):
+    """
+    @return the proof packed at `offset` of `data`, and the offset right after it
+    """
+    count, = PROOF_HEADER.unpack_from(data, offset)
+    offset += PROOF_HEADER.size
+    proof = [bytes(data[offset + i * HASH_BYTES:offset + (i + 1) * HASH_BYTES]) for i in range(count)]
+    return proof, offset + count * HASH_BYTES
@@ -1,12 +1,83 @@
-import heapq
 import json
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from selectors import DefaultSelector, EVENT_READ
+from time import sleep, time
 from traceback import print_exc
-from socket import socket
-from threading import Thread
+from socket import socket, IPPROTO_TCP, TCP_NODELAY, SOL_SOCKET, SO_REUSEADDR, SHUT_WR
+from threading import BoundedSemaphore, Lock, Thread
 
 import protocol
+from protocol import NodeBusy
+from compression import choose, parse_codecs
+from connection import ConnectionPool, encode_frame_header, read_frame, send_frame, send_response
+from async_engine import AsyncEngine
+
+
+class ConnectionReaper(Thread):
+    """
+    Closes the connections a node refused, each once the client has closed it or BUSY_LINGER after it was refused, whichever comes first. Closing first could reset the connection and lose the 'busy' answer with it. One thread serves all of them, and at most MAX_CONNECTIONS wait at once: any more are closed right away.
+    """
+
+    def __init__(self):
+        super().__init__(name='reaper', daemon=True)
+        self.__refused = Queue()
+        self.__selector = DefaultSelector()
+        self.__deadlines = {}
+
+    def refuse(self, sock, reply):
+        """
+        Send `reply`, a whole frame, and leave the socket to be closed. Called from the accept loop, so nothing here blocks
+        """
+        try:
+            sock.setblocking(False)
+            # A few bytes on a new connection, which always fit in its send buffer
+            sock.send(reply)
+            sock.shutdown(SHUT_WR)
+        except OSError:
+            sock.close()
+            return
+        self.__refused.put(sock)
+
+    def run(self):
+        while True:
+            # Nothing to wait for: sleep until a connection is refused
+            if not self.__deadlines:
+                self.__add(self.__refused.get())
+            while True:
+                try:
+                    self.__add(self.__refused.get_nowait())
+                except Empty:
+                    break
+            # Woken up regularly to pick up newly refused connections
+            timeout = min(protocol.WORKER_POLL_INTERVAL, max(0, min(self.__deadlines.values()) - time()))
+            for key, _ in self.__selector.select(timeout):
+                try:
+                    data = key.fileobj.recv(protocol.BUFF_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    self.__close(key.fileobj)
+            now = time()
+            for sock, deadline in list(self.__deadlines.items()):
+                if deadline <= now:
+                    self.__close(sock)
+
+    def __add(self, sock):
+        if len(self.__deadlines) >= protocol.MAX_CONNECTIONS:
+            sock.close()
+            return
+        self.__deadlines[sock] = time() + protocol.BUSY_LINGER
+        self.__selector.register(sock, EVENT_READ)
+
+    def __close(self, sock):
+        self.__selector.unregister(sock)
+        del self.__deadlines[sock]
+        sock.close()
 
 
 class Node:
@@ -16,61 +87,135 @@ class Node:
         self.host = kwargs['host']
         self.port = int(kwargs['port'])
         self.name = kwargs.get('name', self.__get_class_name())
-        dynamic_port_range = kwargs.get('dynamic_port_range', '49152-65535')
-        self.available_ports = list(range(*[int(port) for port in dynamic_port_range.split('-')]))
-        heapq.heapify(self.available_ports)
+        # 'dynamic_port_range' is still accepted for existing command files, but every connection is served on the listening port
 
         logging.basicConfig(level=logging.INFO)
         self._logger = logging.getLogger(self.name)
+        # Codecs this node asks the nodes it connects to to compress responses with, preferred first. Responses to this node's own clients are compressed with whatever they ask for
+        self.compression = parse_codecs(kwargs.get('compression'))
+        self._connection_pool = ConnectionPool(self.compression)
+
+        # 'thread' serves every connection on its own thread. 'asyncio' serves all of them from one event loop
+        self.engine = kwargs.get('engine') or 'thread'
+
+        # Admission control: a request is handled only if it gets one of these slots, otherwise it is answered 'busy'. Slots cover the requests being handled and those waiting for a worker
+        self.request_workers = int(kwargs.get('request_workers') or protocol.REQUEST_WORKERS)
+        request_queue_limit = kwargs.get('request_queue_limit')
+        self.request_queue_limit = int(request_queue_limit) if request_queue_limit is not None else protocol.REQUEST_QUEUE_LIMIT
+        self._admission = BoundedSemaphore(self.request_workers + self.request_queue_limit)
+        self._busy_reply = self.encode_byte_json({ 'retry_after': protocol.BUSY_RETRY_AFTER })
+        # Long polls ('loc_delta', 'have') allowed to wait at once. At most half of the request workers, so that the others always serve everything else
+        self._max_waiters = min(protocol.SUBSCRIBE_MAX_WAITERS, self.request_workers // 2)
+        self._async_engine = AsyncEngine(self) if self.engine == 'asyncio' else None
 
     @classmethod
     def __get_class_name(cls):
         return cls.__name__
 
-    def __recvall(self, sock):
-        data = b''
-        while True:
-            part = sock.recv(protocol.BUFF_SIZE)
-            data += part
-            if len(part) < protocol.BUFF_SIZE:
-                break
-        return data
-
     def __preprocess_message(self, message):
         message['args']['address'] = ':'.join([self.host, str(self.port)])
         if protocol.COMMANDS[message['action']]['type_request'] == 'json':
             message = json.dumps(message)
         return message
 
-    def __on_new_client(self, sock, address):
-        # ASSUMPTION: number of ports is good enough
-        port = heapq.heappop(self.available_ports)
+    def __on_new_client(self, sock, address, request_executor, connection_slots):
+        """
+        Serve one connection until the other side closes it. A connection carries any number of requests, and each of them is handled by `request_executor` so that a slow request does not hold up the ones behind it. Requests that find no admission slot are answered 'busy' right away.
+        """
+        send_lock = Lock()
+        # Requests of this connection that are being handled, and whether the client has cancelled them
+        cancelled = {}
+        # Compression codec the client asked for, if any
+        codec = None
+        try:
+            while True:
+                frame = read_frame(sock)
+                if frame is None:
+                    break
+                frame_type, flags, request_id, body = frame
+                if frame_type == protocol.FRAME_TYPES['cancel']:
+                    if request_id in cancelled:
+                        cancelled[request_id] = True
+                    continue
+                if frame_type == protocol.FRAME_TYPES['hello']:
+                    codec = self._decode_hello(body)
+                    continue
+                if not self._admission.acquire(blocking=False):
+                    with send_lock:
+                        send_frame(sock, protocol.FRAME_TYPES['busy'], request_id, self._busy_reply)
+                    continue
+                cancelled[request_id] = False
+                request_executor.submit(self.__on_new_request, sock, send_lock, cancelled, codec, request_id, body)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print_exc()
+        sock.close()
+        connection_slots.release()
+
+    def __on_new_request(self, sock, send_lock, cancelled, codec, request_id, body):
+        try:
+            action, args = self._decode_request(body)
+            frame_type, response = self._process_request(action, args)
+            try:
+                send_response(sock, send_lock, frame_type, request_id, response, cancelled, codec)
+            except OSError:
+                self._logger.debug('Connection closed before request {} was answered'.format(request_id))
+        finally:
+            cancelled.pop(request_id, None)
+            self._admission.release()
+
+    def _decode_request(self, body):
+        """
+        Decode a request body and returns the action (str) and args (dict). Example:
+
+        input: b'{"action": "list", "args": {"address": "127.0.0.1:3029"}}'
+        output: 'list', {'address': '127.0.0.1:3029'}
+        """
+        try:
+            body = json.loads(body.decode('utf-8'))
+            return body['action'], body['args']
+        except Exception as e:
+            self._logger.warning('Malformed request: {}'.format(e))
+            return None, {}
+
+    def _decode_hello(self, body):
+        """
+        @return the codec to compress responses on a connection with, from the hello frame the client opened it with. Example:
+
+        input: b'{"codecs": ["lzma", "zlib"]}'
+        output: 'lzma'
+        """
+        try:
+            return choose(json.loads(body.decode('utf-8')).get('codecs'))
+        except Exception as e:
+            self._logger.warning('Malformed hello: {}'.format(e))
+            return None
+
+    def _process_request(self, action, args):
+        """
+        Run the handler of an action and returns the frame type (int) and the encoded response (bytes, FileRegion or Stream). This is shared by every engine.
+        """
         try:
-            message = self.__recvall(sock)
-            length, body = self.parse_message(message)
-            if len(body) != length:
-                raise Exception('Corrupted body')
-            body = json.loads(body)
-            action = body['action']
-            args = body['args']
             self._logger.debug('Request received: {}'.format(action))
 
             # If this action is not valid, or not supported from this node type (Peer or Server), then send back 404
-            if action not in protocol.COMMANDS or self.__get_class_name().lower() not in protocol.COMMANDS[action]['request_to'].split(','):
+            if action not in protocol.COMMANDS or self.__get_class_name().lower() not in protocol.COMMANDS[action].get('request_to', '').split(','):
                 self._logger.warning('No handler available for this action')
-                sock.sendall(json.dumps({ 'status': 404 }).encode('utf-8'))
+                response = self.encode_byte_json({ 'status': 404 })
+                type_response = 'json'
             else:
                 handler = getattr(self, protocol.COMMANDS[action]['handler'])
                 response = handler(args)
-                if protocol.COMMANDS[action]['type_response'] == 'json':
+                type_response = protocol.COMMANDS[action]['type_response']
+                # Handlers may return JSON they have encoded already, e.g. from a cache
+                if type_response == 'json' and not isinstance(response, (bytes, bytearray)):
                     response = self.encode_byte_json(response)
-                sock.sendall(response)
-        except KeyboardInterrupt:
-            pass
         except Exception as e:
             print_exc()
-        sock.close()
-        heapq.heappush(self.available_ports, port)
+            response = self.encode_byte_json({ 'status': 500 })
+            type_response = 'json'
+        return protocol.FRAME_TYPES[type_response], response
 
     @classmethod
     def info_usage(cls):
@@ -98,48 +243,54 @@ class Node:
     def handler_inspect(self, variable):
         self._logger.info(getattr(self, variable))
 
-    def parse_message(self, message):
+    def submit(self, host, port, message):
         """
-        Parse a message and returns the action (str) and args (byte json str). Example:
-
-        input: 'reg_file {"files": ["/Users/a67/Desktop/test.sql"]}'
-        output: 'reg_file', '{"files": ["/Users/a67/Desktop/test.sql"]}'
+        Send a request without waiting for the response. Returns a PendingResponse, from which the response is read with get() or, for streamed responses, stream().
         """
-        if not message:
-            return -1, ''
-        length = ''
-        body = ''
-        message = message.decode('utf-8')
-        for i in range(0, len(message)):
-            if message[i].isdigit():
-                length += message[i]
-            elif message[i] == ' ':
-                body = message[i+1:]
-                break
-            else:
-                raise Exception('ERROR: Incorrect separator between length and body')
-        return int(length), body
+        frame_type = protocol.FRAME_TYPES[protocol.COMMANDS[message['action']]['type_request']]
+        message = self.__preprocess_message(message)
+        if self._async_engine:
+            return self._async_engine.submit(host, port, message.encode('utf-8'), frame_type)
+        return self._connection_pool.submit(host, port, message.encode('utf-8'), frame_type)
 
     def request(self, host, port, message):
-        message = self.__preprocess_message(message)
-        with socket() as sock:
-            sock.connect((host, int(port)))
-            sock.sendall('{message_length} {message}'.format(
-                message_length=len(message),
-                message=message,
-            ).encode('utf-8'))
-            response = self.__recvall(sock)
-        return response
+        """
+        Send a request and wait for its response. A request the other node is too busy for is tried again after the delay it asks for, up to BUSY_RETRIES times.
+        """
+        for _ in range(protocol.BUSY_RETRIES):
+            try:
+                return self.submit(host, port, message).get()
+            except NodeBusy as e:
+                self._logger.debug('{}:{} is busy, retrying in {}s'.format(host, port, e.retry_after))
+                sleep(e.retry_after)
+        return self.submit(host, port, message).get()
 
     def listen(self):
+        """
+        Serve connections until interrupted. With the 'thread' engine, every connection is read by its own thread, up to MAX_CONNECTIONS of them, and requests are handled by a pool of `request_workers` threads. Connections beyond MAX_CONNECTIONS are answered 'busy' and closed.
+        """
+        if self._async_engine:
+            self._async_engine.listen()
+            return
+        connection_slots = BoundedSemaphore(protocol.MAX_CONNECTIONS)
+        busy_frame = encode_frame_header(protocol.FRAME_TYPES['busy'], 0, len(self._busy_reply)) + self._busy_reply
+        reaper = ConnectionReaper()
+        reaper.start()
+        request_executor = ThreadPoolExecutor(max_workers=self.request_workers, thread_name_prefix='{}-request'.format(self.name))
         sock = socket()
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         sock.bind((self.host, self.port))
-        sock.listen()
+        sock.listen(protocol.LISTEN_BACKLOG)
         self._logger.info('Waiting for new connections...')
         while True:
             try:
                 conn, address = sock.accept()
-                t = Thread(target=self.__on_new_client, args=(conn, address))
+                if not connection_slots.acquire(blocking=False):
+                    self._logger.warning('Too many connections, refusing the one from {}'.format(address))
+                    reaper.refuse(conn, busy_frame)
+                    continue
+                conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                t = Thread(target=self.__on_new_client, args=(conn, address, request_executor, connection_slots))
                 t.start()
             except KeyboardInterrupt:
                 break
@@ -147,3 +298,4 @@ class Node:
                 print_exc()
                 break
         sock.close()
+        request_executor.shutdown(wait=False)
@@ -2,19 +2,29 @@ import os
 import sys
 import json
 import hashlib
-from collections import defaultdict
+import random
+from collections import defaultdict, deque
 from queue import PriorityQueue, Empty
-from os.path import join, exists
+from os.path import join, exists, abspath, isabs, normpath
 from traceback import print_exc
 from socket import socket
-from threading import Thread, Event
-from time import sleep
+from threading import Thread, Event, BoundedSemaphore
+from time import sleep, time
 from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
 
 import protocol
-from protocol import DownloadFail
+from protocol import DownloadFail, ConnectionClosed, NodeBusy
 from node import Node
-from workers import QueueWorker, Watcher
+from connection import FileRegion, OpenFiles, Stream, CHUNK_HEADER, is_chunkid
+from workers import QueueWorker, Watcher, Announcer, Poller
+from download import Download
+from exchange import HaveLog, SwarmExchange
+from bitfield import Bitfield
+from scheduler import PeerScheduler
+import hashing
+from manifest import Manifest
+from merkle import MerkleTree, pack_proof, unpack_proof
 
 LOCAL_TMP_DIR_TOP_LEVEL = 'chunks'
 MESSAGE_SUCCESS = """
@@ -47,9 +57,43 @@ class Peer(Node):
         else:
             self.tmp_dir = mkdtemp(dir=LOCAL_TMP_DIR_TOP_LEVEL)
 
+        # md5s of local files from earlier scans, so that files that have not changed are not read again
+        self.__manifest = Manifest(join(self.tmp_dir, 'manifest'))
+
+        # Chooses which peer to download each chunk from, based on how every peer has performed so far
+        self.__scheduler = PeerScheduler()
+
+        # Downloaded chunks are registered on the server in batches, from the announcer thread
+        self.__announcer = Announcer(self.__announce_chunks, self._logger, protocol.ANNOUNCE_BATCH_SIZE, protocol.ANNOUNCE_INTERVAL)
+        self.__announcer.start()
+
+        # Files this peer serves chunks of, straight from where they are on disk. They are opened when a chunk is sent, and only the PEER_OPEN_FILES most recently used are kept open
+        self.__shared_files = {}
+        self.__open_files = OpenFiles(protocol.PEER_OPEN_FILES)
+        """
+        self.__shared_files = {
+            'f1.txt': {
+                'filepath': 'test_files/f1.txt',
+                'bytes': 444,
+                'bytes_per_chunk': 1024,
+                'have': None,
+                'proof': None,      # for files in Merkle integrity mode, returns the proof of a chunk id, or None if it is not known
+                'have_log': <HaveLog>,  # what other peers are told this peer has of the file
+            }
+        }
+        """
+
+        # Downloads in progress by filename, with the peers each exchanges have-bitmaps with, so that peers asking about the file are taken as sources
+        self.__exchanges = {}
+        # Slots for 'have' requests waiting for a new chunk
+        self.__waiters = BoundedSemaphore(self._max_waiters)
+
+        # Merkle trees of files being registered, from the scan until the server has accepted them. Only the roots are sent
+        self.__merkle_trees = {}
+
     def _preprocess_message_reg_file(self, message):
         """
-        Before the peer registers a file, it needs to break the file into chunks and also compute the md5 of each chunk, as well as the whole file. It needs to send all of these md5 to the server. This function modifies the mssage IN PLACE
+        Before the peer registers a file, it needs to compute the md5 of each chunk, as well as the whole file. It needs to send all of these md5 to the server. This function modifies the mssage IN PLACE
 
         @param message: type dict
         @return None
@@ -64,23 +108,43 @@ class Peer(Node):
         for filepath in to_be_deleted:
             message['args']['files'].remove(filepath)
 
-        # Compute size and md5 information
-        for i, filepath in enumerate(message['args']['files']):
-            filename = filepath.split('/')[-1]
-            md5_full = self.__get_md5_from_file(filepath)
-            md5_chunks = self.__get_chunks_md5_from_file(filepath)
-            file_data = {
-                'filename': filename,
-                'bytes': os.stat(filepath).st_size,
-                'md5_full': md5_full,
-                'md5_chunks': md5_chunks,
-            }
-            message['args']['files'][i] = file_data
+        algorithm = message['args'].get('hash', hashing.DEFAULT_ALGORITHM)
+        if algorithm not in hashing.ALGORITHMS:
+            self._logger.warning('Hash algorithm {} is not available, choose one of {}'.format(algorithm, ', '.join(hashing.ALGORITHMS)))
+            message['args']['files'] = []
 
-            file_data['filepath'] = filepath
-            self.__split_file_into_chunks(filepath)
+        # Compute size and md5 information. Files are scanned in parallel, and each of them is read only once
+        filepaths = message['args']['files']
+        bytes_per_chunk = message['args'].get('bytes_per_chunk')
+        if filepaths:
+            with ThreadPoolExecutor(max_workers=min(len(filepaths), os.cpu_count() or 1)) as executor:
+                message['args']['files'] = list(executor.map(lambda filepath: self.__scan_file(filepath, bytes_per_chunk, algorithm), filepaths))
         message['args']['count'] = len(message['args']['files'])
 
+        # In Merkle integrity mode the chunk md5s stay here, as the leaves of the tree. The server only gets the root
+        if message['args'].get('integrity') == 'merkle':
+            for file_data in message['args']['files']:
+                tree = MerkleTree([bytes.fromhex(md5) for md5 in file_data.pop('md5_chunks')], algorithm)
+                file_data['merkle_root'] = tree.root.hex()
+                file_data['num_chunks'] = tree.num_leaves
+                self.__merkle_trees[file_data['filepath']] = tree
+
+    def _postprocess_response_reg_file(self, message, response):
+        """
+        Once the server has accepted a file, start serving its chunks from the original file.
+
+        @param message: type dict, as modified by _preprocess_message_reg_file
+        @param response: type bytes
+        @return None
+        """
+        accepted = {}
+        for entry in json.loads(response.decode('utf-8')):
+            accepted.update(entry)
+        for file_data in message['args']['files']:
+            tree = self.__merkle_trees.pop(file_data['filepath'], None)
+            if accepted.get(file_data['filename']):
+                self.__share_file(file_data['filename'], file_data['filepath'], file_data['bytes'], file_data['bytes_per_chunk'], proof=tree.proof if tree else None)
+
     def __request_server(self, action, args):
         """
         This function serves to request a server
@@ -92,12 +156,18 @@ class Peer(Node):
         preprocess_function_name = '_preprocess_message_' + action
         if hasattr(self, preprocess_function_name):
             getattr(self, preprocess_function_name)(message)
-        return self.request(self.__server_host, self.__server_port, message)
+        response = self.request(self.__server_host, self.__server_port, message)
+        postprocess_function_name = '_postprocess_response_' + action
+        if hasattr(self, postprocess_function_name):
+            getattr(self, postprocess_function_name)(message, response)
+        return response
 
     def __request_peers(self, action, args):
         """
-        This function serves to request a peer. Curently it only handles 'download' action.
+        This function serves to request a peer. Curently it only handles 'download' and 'download_batch' actions.
         """
+        if action == 'download_batch':
+            return self.__download_batch(args)
         if action == 'download':
             """
             In download, procedures are divided into 3 groups: preprocessing, processing, postprocessing.
@@ -110,28 +180,30 @@ class Peer(Node):
             2. precompute essential mappings for optimization of computation
             3. initialize a priority queue based on the chunks. Each item is a chunk info.
             """
-            response = self.__request_server('loc', {
+            response = json.loads(self.__request_server('loc', {
                 'filename': args['filename'],
                 'include_md5': True,
-            })
-            response = json.loads(response.decode('utf-8'))
-            if len(response['addresses']) == 0:
-                self._logger.info('Fail. Reason: file does not exist in network or no available peers have the file')
+                'range': [0, protocol.LOC_RANGE_CHUNKS],
+            }).decode('utf-8'))
+            self.__locate_remaining_chunks(args['filename'], response)
+            download = self.__prepare_download(args['filename'], args['destination'], response)
+            if download is None:
                 return
-            file_bytes = response['bytes']
-            file_md5 = response['md5']
             addresses = response['addresses']
+            task_queue = PriorityQueue()
+            self.__queue_download_tasks(task_queue, download, args['scheme'])
 
-            chunkid_to_addresses = defaultdict(dict)
-            chunkid_to_md5 = dict()
-            for entry in addresses:
-                address = ':'.join([entry['host'], str(entry['port'])])
-                for chunk in entry['chunks']:
-                    chunkid_to_addresses[chunk['id']][address] = True
-                    chunkid_to_md5[chunk['id']] = chunk['md5']
-            sorted_chunkids = sorted([key for key in chunkid_to_addresses])
-
-            task_queue = self.__make_download_task_queue(args['filename'], args['scheme'], chunkid_to_addresses, chunkid_to_md5)
+            # The holders the tracker listed are asked what they have, and who else has the file. From then on sources are found through other peers
+            exchange = SwarmExchange(
+                ':'.join([self.host, str(self.port)]),
+                lambda address: self.__start_exchange(download, task_queue, args['scheme'], exchange, address),
+            )
+            exchange.learn([':'.join([entry['host'], str(entry['port'])]) for entry in addresses])
+            self.__exchanges[download.filename] = (download, exchange)
+            exchange.refill()
+            # Version of the holders of the file on the server that chunkid_to_addresses is up to date with
+            availability = { 'version': response.get('version') }
+            state_saved_at = [time()]
             
             """
             Processing:
@@ -142,12 +214,10 @@ class Peer(Node):
             4. Wait until all tasks in the queue are consumed
             5. Stop all threads
             """
-            fail = False
             def handle_fail():
                 """
                 This function clears the queue upon download failure
                 """
-                fail = True
                 while not task_queue.empty():
                     try:
                         task_queue.get(False)
@@ -156,16 +226,31 @@ class Peer(Node):
                     task_queue.task_done()
 
             def watcher_routine(caller):
-                num_total = len(sorted_chunkids)
-                num_complete = len(caller.data)
+                num_total = download.num_chunks
+                num_complete = len(download.have)
                 percentage = num_complete / num_total
                 total_marks = 50
                 num_marks = int(percentage * total_marks)
                 sys.stdout.write('\r{}{}> {}%'.format(self.name, '='*(num_marks),round(percentage, 4) * 100))
                 sys.stdout.flush()
 
+                if time() - state_saved_at[0] >= protocol.DOWNLOAD_STATE_INTERVAL:
+                    state_saved_at[0] = time()
+                    download.save_state()
+
+            def subscriber_routine():
+                # The tracker is only followed while no other peer tells this one about the swarm
+                if len(exchange):
+                    return
+                availability['version'] = self.__refresh_availability(download, task_queue, args['scheme'], availability['version'], wait=protocol.SUBSCRIBE_WAIT)
+
             watcher = Watcher(self._logger, handle_fail, routine_function=watcher_routine)
             watcher.start()
+            # Follows the holders of the file on the server for as long as the download runs
+            subscriber = None
+            if availability['version'] is not None:
+                subscriber = Poller(subscriber_routine, self._logger, protocol.AVAILABILITY_REFRESH_INTERVAL, name='subscriber')
+                subscriber.start()
             workers = []
             for i in range(self.__num_download_threads):
                 worker = QueueWorker(
@@ -174,6 +259,7 @@ class Peer(Node):
                     task_queue,
                     watcher,
                     name=str(i),
+                    idle_handler=lambda: self.__endgame_download_chunk(download),
                 )
                 workers.append(worker)
                 worker.start()
@@ -184,59 +270,311 @@ class Peer(Node):
                 worker.join()
             watcher.shutdown_flag.set()
             watcher.join()
+            if subscriber is not None:
+                # Not joined: it may be waiting on the server for a change nobody needs anymore
+                subscriber.shutdown_flag.set()
+            exchange.stop()
+            self.__exchanges.pop(download.filename, None)
 
             """
             Postprocessing:
 
-            1. If download fail, notify failure.
-            2. If md5 calculated by adding all chunks together does not match the md5 returned from the server, notify failure.
-            3. Combine chunks to file.
-            4. If file size does not match, remove the downloaded file and notify failure.
-            5. Otherwise, notify success and output the result
+            1. If some chunks are missing, keep what was downloaded for a later resume and notify failure.
+            2. If the md5 of the destination file does not match the md5 returned from the server, remove it and notify failure.
+            3. Otherwise, notify success and output the result
             """
-            if fail:
-                self._logger.info('Fail. Reason: download fail.')
-            elif self.__check_md5_equal(args['filename'], sorted_chunkids, file_md5):
-                self._logger.info('Fail. Reason: MD5 not match')
-            else:
-                self.__combine_chunks_to_file(args['destination'], args['filename'], sorted_chunkids)
-                if not self.__check_bytes_equal(args['destination'], file_bytes):
-                    self._logger.info('Fail. Reason: size not match.')
-                    os.system('rm {}'.format(args['destination']))
-                else:
-                    chunk_information = '\n'.join([
-                        'Chunk{chunkid}: downloaded from {download_from_address}. Available from: {available_addresses}'.format(
-                            chunkid=entry['chunkid'],
-                            download_from_address=entry['download_from_address'],
-                            available_addresses=entry['available_addresses'],
-                        )
-                        for entry in watcher.data[:20]
-                    ])
-                    self._logger.info(MESSAGE_SUCCESS.format(
-                        filepath=args['destination'],
-                        chunk_information=chunk_information,
-                        cdots='......' if len(watcher.data) > 20 else '',
-                    ))
+            # Make sure the server knows about every chunk before this command returns
+            self.__announcer.flush()
+            if self.__finish_download(download):
+                chunk_information = '\n'.join([
+                    'Chunk{chunkid}: downloaded from {download_from_address}. Available from: {available_addresses}'.format(
+                        chunkid=entry['chunkid'],
+                        download_from_address=entry['download_from_address'],
+                        available_addresses=entry['available_addresses'],
+                    )
+                    for entry in watcher.data[:20]
+                ])
+                self._logger.info(MESSAGE_SUCCESS.format(
+                    filepath=args['destination'],
+                    chunk_information=chunk_information,
+                    cdots='......' if len(watcher.data) > 20 else '',
+                ))
+
+    def __download_batch(self, args):
+        """
+        Download many files, e.g. a data set of thousands of small ones, into the directory args['destination']. They are located with 'loc_batch', LOC_BATCH_FILES at a time, and the chunks of all of them go through one task queue served by one pool of download threads, so the download threads and the request slots of the peer scheduler are shared by every file instead of being set up again for each. Up to BATCH_ACTIVE_FILES files are open at once; the others are started as those finish.
+
+        A file that fails does not stop the others. Unlike with 'download', files do not follow their holders on the tracker or through other peers once started: a batch is meant for files small enough to be done with the holders 'loc_batch' listed.
+        """
+        located = self.__locate_batch(args)
+        pending = deque(sorted(located.items()))
+        num_files = len(pending)
+        task_queue = PriorityQueue()
+        active = {}
+        # The active downloads, for the endgame of the download threads. Replaced as a whole whenever it changes
+        downloads = [()]
+        downloaded = []
+        failed = []
+        next_key = 0
+
+        def handle_fail():
+            while not task_queue.empty():
+                try:
+                    task_queue.get(False)
+                except Empty:
+                    continue
+                task_queue.task_done()
+
+        def watcher_routine(caller):
+            sys.stdout.write('\r{} {} of {} files'.format(self.name, len(downloaded) + len(failed), num_files))
+            sys.stdout.flush()
+
+        def endgame():
+            for download in downloads[0]:
+                if not download.failed:
+                    results = self.__endgame_download_chunk(download)
+                    if results is not None:
+                        return results
+            return None
+
+        watcher = Watcher(self._logger, handle_fail, routine_function=watcher_routine)
+        watcher.start()
+        workers = []
+        for i in range(self.__num_download_threads):
+            worker = QueueWorker(self.__task_handler_download_chunk, self._logger, task_queue, watcher, name=str(i), idle_handler=endgame)
+            workers.append(worker)
+            worker.start()
+
+        while pending or active:
+            for filename, download in list(active.items()):
+                if download.complete() or download.failed:
+                    del active[filename]
+                    (downloaded if self.__finish_download(download) else failed).append(filename)
+            while pending and len(active) < protocol.BATCH_ACTIVE_FILES:
+                filename, response = pending.popleft()
+                download = self.__start_batch_file(filename, response, args['destination'])
+                if download is None:
+                    failed.append(filename)
+                    continue
+                active[filename] = download
+                next_key = self.__queue_download_tasks(task_queue, download, args['scheme'], next_key, batch=True)
+            downloads[0] = tuple(active.values())
+            if not any(worker.is_alive() for worker in workers):
+                break
+            sleep(protocol.WORKER_POLL_INTERVAL)
+
+        for worker in workers:
+            worker.shutdown_flag.set()
+        for worker in workers:
+            worker.join()
+        watcher.shutdown_flag.set()
+        watcher.join()
+        for filename, download in active.items():
+            (downloaded if self.__finish_download(download) else failed).append(filename)
+        # Make sure the server knows about every chunk before this command returns
+        self.__announcer.flush()
+        self._logger.info('Downloaded {} of {} files to {}'.format(len(downloaded), num_files, args['destination']))
+        if failed:
+            self._logger.info('Fail. Reason: could not download {}'.format(', '.join(sorted(failed))))
+
+    def __locate_batch(self, args):
+        """
+        @return what 'loc' returns about every file of a batch download, by filename
+        """
+        located = {}
+        filenames = list(dict.fromkeys(args.get('filenames') or []))
+        for i in range(0, len(filenames), protocol.LOC_BATCH_FILES):
+            response = json.loads(self.__request_server('loc_batch', {
+                'filenames': filenames[i:i + protocol.LOC_BATCH_FILES],
+                'include_md5': True,
+            }).decode('utf-8'))
+            located.update(response['result'])
+        if args.get('pattern') is not None:
+            cursor = None
+            while True:
+                response = json.loads(self.__request_server('loc_batch', {
+                    'pattern': args['pattern'],
+                    'include_md5': True,
+                    'cursor': cursor,
+                }).decode('utf-8'))
+                located.update(response['result'])
+                cursor = response['next']
+                if cursor is None:
+                    break
+        return located
+
+    def __start_batch_file(self, filename, response, directory):
+        """
+        Open the Download of one file of a batch, at its name under `directory`.
+
+        @return the Download, or None if the file cannot be downloaded
+        """
+        destination = normpath(join(directory, filename))
+        if isabs(filename) or not destination.startswith(join(normpath(directory), '')):
+            self._logger.info('Fail. Reason: {} would be written outside of {}'.format(filename, directory))
+            return None
+        self.__locate_remaining_chunks(filename, response)
+        download = self.__prepare_download(filename, destination, response)
+        if download is None:
+            return None
+        if any(not download.chunkid_to_addresses.get(chunkid) for chunkid in download.have.missing()):
+            # Nobody is known to have some of the chunks, so the file could never be complete
+            self._logger.info('Fail. Reason: no available peers have every chunk of {}'.format(filename))
+            self.__finish_download(download)
+            return None
+        return download
 
     def __task_handler_download_chunk(self, task_queue, task):
         """
         This is the function for all download thread to run.
+
+        The peer scheduler picks which of the holders of the chunk to ask, and how many requests can be sent to it (up to PIPELINE_DEPTH). Along with `task`, the thread takes more tasks from the queue whose chunk the same peer has, and asks that peer for them in range requests of up to CHUNKS_PER_REQUEST chunks of one file each. All of these requests are sent before the first response is read, so the connection stays busy while chunks are being verified and written.
         """
-        addresses = [key for key in task[2]['addresses']]
-        address = addresses[0]
+        address, num_requests = self.__scheduler.acquire(list(task[2]['addresses']), protocol.PIPELINE_DEPTH)
         peer_host, peer_port = address.split(':')
-        message = {
-            'action': 'download',
-            'args': {
-                'filename': task[2]['filename'],
-                'chunkid': task[2]['chunkid'],
-            },
-        }
-        response = self.request(peer_host, peer_port, message)
-        chunk_md5 = self.__get_md5_from_data(response)
+        tasks = [task] + self.__take_tasks_for_address(task_queue, address, protocol.CHUNKS_PER_REQUEST * num_requests - 1)
+        batches = self.__split_requests(task_queue, tasks, num_requests)
+        if len(batches) < num_requests:
+            # Fewer chunks to ask for than slots reserved
+            self.__scheduler.give_back(address, num_requests - len(batches))
+        # Keyed by file as well, since the tasks of a batch download come from any of its files
+        unhandled = { (t[2]['filename'], t[2]['chunkid']): t for batch in batches for t in batch }
+        results = []
+        requests = []
+        try:
+            for batch in batches:
+                response = None
+                try:
+                    response = self.submit(peer_host, peer_port, {
+                        'action': 'download',
+                        'args': {
+                            'filename': batch[0][2]['filename'],
+                            'chunkids': [t[2]['chunkid'] for t in batch],
+                            'proof': batch[0][2]['download'].merkle_root is not None,
+                        },
+                    })
+                except ConnectionClosed as e:
+                    self._logger.warning('Fail to request chunks from {}: {}'.format(address, e))
+                for t in batch:
+                    t[2]['download'].start_request(t[2]['chunkid'], address, response)
+                requests.append([batch, response, time()])
+
+            while requests:
+                batch, response, start = requests.pop(0)
+                num_bytes = 0
+                failed = response is None
+                retry_after = None
+                try:
+                    if response:
+                        try:
+                            for payload in response.stream():
+                                num_bytes += len(payload)
+                                chunkid, data, proof = self.__split_chunk_frame(batch[0][2]['download'], payload)
+                                if (batch[0][2]['filename'], chunkid) in unhandled:
+                                    result = self.__handle_chunk(task_queue, unhandled.pop((batch[0][2]['filename'], chunkid)), address, data, proof)
+                                    if result:
+                                        results.append(result)
+                        except NodeBusy as e:
+                            self._logger.debug('{} is busy, backing off for {}s'.format(address, e.retry_after))
+                            retry_after = e.retry_after
+                        except ConnectionClosed as e:
+                            # Cancelled once the endgame has brought every chunk from elsewhere
+                            if not response.cancelled:
+                                self._logger.warning('Fail to download chunks from {}: {}'.format(address, e))
+                                failed = True
+
+                    # Chunks that did not arrive from anywhere count as failed from this address, unless it was only too busy to send them
+                    for t in batch:
+                        key = (t[2]['filename'], t[2]['chunkid'])
+                        if key in unhandled:
+                            if retry_after is not None:
+                                self.__requeue_chunk(task_queue, unhandled.pop(key), address)
+                                continue
+                            if not t[2]['download'].has_chunk(t[2]['chunkid']):
+                                failed = True
+                            self.__handle_chunk(task_queue, unhandled.pop(key), address, None)
+                except DownloadFail:
+                    failed = True
+                    raise
+                finally:
+                    # Given back even when the download fails on this request, which is no longer in `requests`
+                    self.__scheduler.release(address, num_bytes, time() - start, failed, retry_after)
+        finally:
+            # If the download is failing, give back the slots of the requests not read yet and every task this thread still holds, so that the queue can be joined
+            if requests:
+                self.__scheduler.give_back(address, len(requests))
+            for t in unhandled.values():
+                task_queue.task_done()
+        return results
+
+    def __take_tasks_for_address(self, task_queue, address, limit):
+        """
+        Take up to `limit` more tasks from the queue whose chunk is available at `address`. Tasks for other addresses are put back.
+        """
+        tasks = []
+        skipped = []
+        while len(tasks) < limit and len(skipped) < limit:
+            try:
+                task = task_queue.get_nowait()
+            except Empty:
+                break
+            if address in task[2]['addresses']:
+                tasks.append(task)
+            else:
+                skipped.append(task)
+        for task in skipped:
+            task_queue.put(task)
+            task_queue.task_done()
+        return tasks
+
+    def __split_requests(self, task_queue, tasks, num_requests):
+        """
+        Group tasks into at most `num_requests` range requests of up to CHUNKS_PER_REQUEST chunks of one file each, keeping their order. Tasks that fit in none are put back, and those of downloads that failed already are dropped.
+
+        @return the tasks of every request
+        """
+        by_file = {}
+        for task in tasks:
+            if task[2]['download'].failed:
+                task_queue.task_done()
+                continue
+            by_file.setdefault(task[2]['filename'], []).append(task)
+        batches = []
+        for file_tasks in by_file.values():
+            for i in range(0, len(file_tasks), protocol.CHUNKS_PER_REQUEST):
+                batches.append(file_tasks[i:i + protocol.CHUNKS_PER_REQUEST])
+        for batch in batches[num_requests:]:
+            for task in batch:
+                task_queue.put(task)
+                task_queue.task_done()
+        return batches[:num_requests]
+
+    def __requeue_chunk(self, task_queue, task, address):
+        """
+        Put back a task whose chunk `address` was too busy to send, with the same holders to pick from. Marks the task done.
+        """
+        task[2]['download'].end_request(task[2]['chunkid'], address)
+        task_queue.put(task)
+        task_queue.task_done()
+
+    def __handle_chunk(self, task_queue, task, address, data, proof=None):
+        """
+        Verify a chunk received from `address` and write it, or retry it from another address. `data` is None if the chunk never arrived. `proof` is what came with it in Merkle integrity mode. Marks the task done.
+
+        @return the chunk information shown on success, or None
+        """
+        download = task[2]['download']
+        download.end_request(task[2]['chunkid'], address)
+        # Copied, since availability refreshes add holders from another thread
+        addresses = list(task[2]['addresses'])
+
+        # An endgame duplicate may have brought this chunk already, in which case whatever came from here does not matter
+        if download.has_chunk(task[2]['chunkid']):
+            task_queue.task_done()
+            return None
 
         # If md5 does not match, then we call this chunk download a failure
-        if chunk_md5 != task[2]['md5']:
+        if data is None or not download.check_chunk(task[2]['chunkid'], data, proof):
             self._logger.warning('MD5 not match: file {filename} of chunk {chunkid} from address {address}'.format(
                 filename=task[2]['filename'],
                 chunkid=task[2]['chunkid'],
@@ -248,12 +586,16 @@ class Peer(Node):
                 # this is the last address on this chunk that can be attempted... We call the whole file download a failure
                 self._logger.warning('No more peers available on chunk {}. Download fail.'.format(task[2]['chunkid']))
                 task_queue.task_done()
+                download.failed = True
+                if task[2].get('batch'):
+                    # The other files of the batch go on
+                    return None
                 raise DownloadFail
 
             # If there are still other addresses available, push a new task in for this chunk
-            task[2]['addresses'].pop(address)
+            task[2]['addresses'].pop(address, None)
             if task[2]['scheme'] == 'rarest_first':
-                task[0] -= 1
+                task = (task[0] - 1,) + task[1:]
             # else:
             #     task[2]['num_retries_left'] -= 1
             #     if task[2]['num_retries_left'] <= -1:
@@ -262,57 +604,366 @@ class Peer(Node):
             #         raise DownloadFail
             task_queue.put(task)
             task_queue.task_done()
+            return None
 
-        # If md5 does match, then we call it a success. We write the chunk to local and register the chunk on the network.
-        else:
-            with open(self.__get_chunk_path(task[2]['filename'], task[2]['chunkid']), 'wb') as f:
-                f.write(response)
-            response = self.__request_server('reg_chunk', {
-                'filename': task[2]['filename'],
-                'chunkid': task[2]['chunkid'],
-                'md5': task[2]['md5'],
+        # If md5 does match, then we call it a success. We write the chunk in place and queue it to be registered on the network.
+        if not self.__write_chunk(download, task[2]['chunkid'], task[2]['md5'] or self.__get_md5_from_data(data, download.algorithm), data):
+            task_queue.task_done()
+            return None
+        task_queue.task_done()
+        return {
+            'chunkid': task[2]['chunkid'],
+            'download_from_address': address,
+            'available_addresses': addresses,
+        }
+
+    def __endgame_download_chunk(self, download):
+        """
+        Run by download threads that find the task queue empty. Once fewer chunks are missing than the download threads can have in flight at once, the last chunks are also asked from holders other than the one already asked. Whichever copy is verified first is written, and the requests for the other copies are cancelled.
+
+        @return a list with the chunk information shown on success, [] if the chunk came some other way, or None if there was nothing to ask for or the request failed, so that the thread waits before it tries again
+        """
+        picked = download.pick_endgame_chunk(self.__num_download_threads * protocol.CHUNKS_PER_REQUEST * protocol.PIPELINE_DEPTH, protocol.ENDGAME_MAX_DUPLICATES)
+        if picked is None:
+            return None
+        chunkid, candidates = picked
+        address, num_requests = self.__scheduler.acquire(candidates, 1)
+        peer_host, peer_port = address.split(':')
+        start = time()
+        data = None
+        proof = None
+        try:
+            response = self.submit(peer_host, peer_port, {
+                'action': 'download',
+                'args': {
+                    'filename': download.filename,
+                    'chunkids': [chunkid],
+                    'proof': download.merkle_root is not None,
+                },
             })
-            if json.loads(response.decode('utf-8'))['result'] == False:
-                self._logger.error('Fail to register chunk {} to the network'.format(task[2]['chunkid']))
+            if not download.start_request(chunkid, address, response, alone=True):
+                # Arrived or asked from there in the meantime
+                response.cancel()
+                self.__scheduler.give_back(address)
+                return []
+            for payload in response.stream():
+                _, data, proof = self.__split_chunk_frame(download, payload)
+        except NodeBusy as e:
+            download.end_request(chunkid, address)
+            self.__scheduler.release(address, 0, 0, False, e.retry_after)
+            return None
+        except ConnectionClosed as e:
+            self._logger.debug('Endgame request for chunk {} to {} ended: {}'.format(chunkid, address, e))
+        download.end_request(chunkid, address)
+
+        if download.has_chunk(chunkid):
+            # Another copy won, this request was probably cancelled
+            self.__scheduler.give_back(address)
+            return []
+        failed = data is None or not download.check_chunk(chunkid, data, proof)
+        self.__scheduler.release(address, 0 if failed else len(data), time() - start, failed)
+        if failed:
+            self._logger.debug('Endgame copy of chunk {} from {} did not arrive or did not match'.format(chunkid, address))
+            # As in __handle_chunk, this holder is not asked for the chunk again unless it is the last one
+            addresses = download.chunkid_to_addresses.get(chunkid)
+            if addresses is not None and len(addresses) > 1:
+                addresses.pop(address, None)
+            return None
+        if not self.__write_chunk(download, chunkid, download.chunkid_to_md5.get(chunkid) or self.__get_md5_from_data(data, download.algorithm), data):
+            return []
+        return [{
+            'chunkid': chunkid,
+            'download_from_address': address,
+            'available_addresses': list(download.chunkid_to_addresses.get(chunkid, ())),
+        }]
+
+    def __split_chunk_frame(self, download, payload):
+        """
+        @return the chunk id, the chunk and, in Merkle integrity mode, its proof
+        """
+        chunkid, = CHUNK_HEADER.unpack_from(payload)
+        if download.merkle_root is None or len(payload) == CHUNK_HEADER.size:
+            return chunkid, memoryview(payload)[CHUNK_HEADER.size:], None
+        proof, offset = unpack_proof(payload, CHUNK_HEADER.size)
+        return chunkid, memoryview(payload)[offset:], proof
+
+    def __write_chunk(self, download, chunkid, md5, data):
+        """
+        Write a verified chunk, queue it to be registered on the network and cancel the requests for other copies of it.
+
+        @return False if another copy was written first
+        """
+        if not download.write_chunk(chunkid, data):
+            return False
+        for pending in download.cancel_requests(chunkid):
+            pending.cancel()
+        shared_file = self.__shared_files.get(download.filename)
+        if shared_file:
+            shared_file['have_log'].add(chunkid)
+        self.__announcer.announce([download.filename, chunkid, md5])
+        return True
+
+    def __announce_chunks(self, chunks):
+        """
+        Register a batch of downloaded chunks on the server. This runs on the announcer thread, or on whichever thread flushes it.
+
+        @param chunks: type list, of [filename, chunkid, md5]
+        """
+        response = self.__request_server('reg_chunks', { 'chunks': chunks })
+        for chunk, registered in zip(chunks, json.loads(response.decode('utf-8'))['result']):
+            if not registered:
+                self._logger.error('Fail to register chunk {} of {} to the network'.format(chunk[1], chunk[0]))
+
+    def __refresh_availability(self, download, task_queue, scheme, version, wait=0):
+        """
+        Catch up with the peers that registered or dropped chunks of the file on the server since `version`, so that workers can ask newly appeared holders. With 'rarest_first', the queued tasks are ranked again by how many holders their chunk has now. If nothing changed since `version`, the server waits up to `wait` seconds for a change before it answers.
+
+        A holder that left is kept for the chunks it is the last known holder of. Asking it then fails, which ends the download as before.
+
+        @return the version chunkid_to_addresses is now up to date with
+        """
+        response = json.loads(self.__request_server('loc_delta', {
+            'filename': download.filename,
+            'since': version,
+            'wait': wait,
+        }).decode('utf-8'))
+        if response['reset']:
+            # The server no longer remembers that far back. Compare with all the current holders instead
+            response = json.loads(self.__request_server('loc', { 'filename': download.filename }).decode('utf-8'))
+            if not response['count']:
+                return version
+            added = { ':'.join([entry['host'], str(entry['port'])]): entry['chunks'] for entry in response['addresses'] }
+            known = { address for addresses in download.chunkid_to_addresses.values() for address in list(addresses) }
+            removed = [address for address in known if address not in added]
+        else:
+            added = response['added']
+            removed = response['removed']
+        if not added and not removed:
+            return response['version']
+
+        own_address = ':'.join([self.host, str(self.port)])
+        for address in removed:
+            self.__remove_holder(download, address)
+        for address, chunkids in added.items():
+            if address != own_address:
+                self.__add_holder(download, address, chunkids)
+
+        if scheme == 'rarest_first':
+            self.__rank_tasks(task_queue)
+        return response['version']
+
+    def __start_exchange(self, download, task_queue, scheme, exchange, address):
+        """
+        @return a started thread that keeps exchanging have-bitmaps of the download with `address`, until the exchange drops it
+        """
+        def exchange_routine():
+            try:
+                self.__exchange_have(download, task_queue, scheme, exchange, address)
+            except ConnectionClosed as e:
+                self._logger.warning('Stop exchanging chunks of {} with {}: {}'.format(download.filename, address, e))
+                exchange.drop(address)
+                self.__remove_holder(download, address)
+
+        poller = Poller(exchange_routine, self._logger, protocol.AVAILABILITY_REFRESH_INTERVAL, name='exchange {}'.format(address))
+        poller.start()
+        return poller
+
+    def __exchange_have(self, download, task_queue, scheme, exchange, address):
+        """
+        One round of 'have' with a partner of the download: the first one swaps whole bitmaps, every later one waits for the chunks the partner adds. The partner becomes a holder of the chunks it has, and the peers it knows of are learnt.
+        """
+        partner = exchange.state(address)
+        if partner is None:
+            return
+        args = {
+            'filename': download.filename,
+            'since': partner['version'],
+        }
+        if partner['version'] is None:
+            args['bitmap'] = download.have.to_bytes().hex()
+        else:
+            args['wait'] = protocol.SUBSCRIBE_WAIT
+        host, port = address.split(':')
+        response = json.loads(self.request(host, port, { 'action': 'have', 'args': args }).decode('utf-8'))
+        if response.get('version') is None:
+            raise ConnectionClosed('{} does not share {}'.format(address, download.filename))
+        if 'bitmap' in response:
+            chunkids = Bitfield.from_bytes(download.num_chunks, bytes.fromhex(response['bitmap']))
+        else:
+            chunkids = response['chunks']
+        partner['version'] = response['version']
+        exchange.learn(response['peers'])
+        if self.__add_holder(download, address, chunkids) and scheme == 'rarest_first':
+            self.__rank_tasks(task_queue)
+        exchange.refill()
+
+    def __add_holder(self, download, address, chunkids):
+        """
+        Take `address` as a source of those of `chunkids` the download still needs. Returns True if it is a new source of any of them
+        """
+        added = False
+        for chunkid in chunkids:
+            addresses = download.chunkid_to_addresses.get(chunkid)
+            if addresses is not None and address not in addresses and not download.has_chunk(chunkid):
+                addresses[address] = True
+                added = True
+        return added
+
+    def __remove_holder(self, download, address):
+        """
+        Stop asking `address` for chunks. It is kept for the chunks it is the last known holder of
+        """
+        for addresses in download.chunkid_to_addresses.values():
+            if address in addresses and len(addresses) > 1:
+                addresses.pop(address, None)
+
+    def __rank_tasks(self, task_queue):
+        """
+        Rank the queued 'rarest_first' tasks again by how many holders their chunk has now
+        """
+        tasks = []
+        while True:
+            try:
+                tasks.append(task_queue.get_nowait())
+            except Empty:
+                break
+        for task in tasks:
+            task_queue.put((len(task[2]['addresses']),) + task[1:])
             task_queue.task_done()
-            return {
-                'chunkid': task[2]['chunkid'],
-                'download_from_address': address,
-                'available_addresses': addresses,
-            }
 
-    def __make_download_task_queue(self, filename, scheme, chunkid_to_addresses, chunkid_to_md5):
+    def __locate_remaining_chunks(self, filename, response):
+        """
+        Holders and md5s are asked LOC_RANGE_CHUNKS chunks at a time, so that no response is too large for a big file. Ask for the chunks after the first range, into the 'addresses' of `response`.
         """
-        This function makes a task queue, which is a priority queue. Two schemes are supported: 'rarest_first' and 'normal'
+        for first in range(protocol.LOC_RANGE_CHUNKS, response.get('num_chunks', 0), protocol.LOC_RANGE_CHUNKS):
+            page = json.loads(self.__request_server('loc', {
+                'filename': filename,
+                'include_md5': True,
+                'range': [first, first + protocol.LOC_RANGE_CHUNKS],
+            }).decode('utf-8'))
+            response['addresses'].extend(page.get('addresses', []))
+
+    def __prepare_download(self, filename, destination, response):
+        """
+        Open the Download of a file from what 'loc' returned about it, resuming it if an earlier download left it there, and start sharing its chunks.
 
-        rarest_first: number of addresses available for the chunk is used as the key
+        @return the Download, or None if the file cannot be downloaded
+        """
+        if len(response['addresses']) == 0:
+            self._logger.info('Fail. Reason: file does not exist in network or no available peers have the file')
+            return None
+        algorithm = response.get('hash', hashing.DEFAULT_ALGORITHM)
+        if algorithm not in hashing.ALGORITHMS:
+            self._logger.info('Fail. Reason: the file is hashed with {}, which is not available here'.format(algorithm))
+            return None
+
+        chunkid_to_addresses = defaultdict(dict)
+        chunkid_to_md5 = dict()
+        for entry in response['addresses']:
+            address = ':'.join([entry['host'], str(entry['port'])])
+            for chunk in entry['chunks']:
+                chunkid_to_addresses[chunk['id']][address] = True
+                # Files in Merkle integrity mode have no chunk md5s
+                if 'md5' in chunk:
+                    chunkid_to_md5[chunk['id']] = chunk['md5']
+        download = Download(
+            filename,
+            destination,
+            response['bytes'],
+            response.get('bytes_per_chunk', protocol.BYTES_PER_CHUNK),
+            response['md5'],
+            chunkid_to_md5,
+            chunkid_to_addresses,
+            state_path=join(self.tmp_dir, 'downloads', hashlib.sha1(abspath(destination).encode('utf-8')).hexdigest() + '.json'),
+            merkle_root=response.get('merkle_root'),
+            algorithm=algorithm,
+        )
+        # Chunks are served to other peers from the destination file as soon as they are written
+        self.__share_file(download.filename, download.destination, download.bytes, download.bytes_per_chunk, have=download.have, proof=download.proof if download.merkle_root else None)
+        if len(download.have):
+            # Resuming: tell the server about the chunks that are already here. Only the rest is queued
+            self._logger.info('Resuming {}: {} of {} chunks already downloaded'.format(download.filename, len(download.have), download.num_chunks))
+            for chunkid in download.have:
+                self.__announcer.announce([download.filename, chunkid, chunkid_to_md5.get(chunkid)])
+        return download
+
+    def __finish_download(self, download):
+        """
+        Once no more chunks of a download are coming: keep what was downloaded of an incomplete file for a later resume, remove a file whose md5 does not match, or share a complete file as a whole.
+
+        @return True if the file is complete and its md5 matches
+        """
+        if not download.complete():
+            # What was downloaded is kept, so that downloading the file again resumes from there
+            self._logger.info('Fail. Reason: download fail. {} of {} chunks are kept in {}'.format(len(download.have), download.num_chunks, download.destination))
+            self.__unshare_file(download.filename)
+            download.save_state()
+            download.close()
+            return False
+        if not download.verify():
+            self._logger.info('Fail. Reason: MD5 not match')
+            self.__unshare_file(download.filename)
+            download.remove()
+            return False
+        tree = download.tree() if download.merkle_root else None
+        download.close()
+        download.remove_state()
+        self.__share_file(download.filename, download.destination, download.bytes, download.bytes_per_chunk, proof=tree.proof if tree else None)
+        # The md5s are all known already, so registering the downloaded file later does not need to read it
+        self.__manifest.put(
+            download.destination,
+            os.stat(download.destination),
+            download.bytes_per_chunk,
+            download.md5,
+            [tree.leaf(chunkid).hex() if tree else download.chunkid_to_md5[chunkid] for chunkid in range(download.num_chunks)],
+            download.algorithm,
+        )
+        return True
+
+    def __queue_download_tasks(self, task_queue, download, scheme, start=0, batch=False):
+        """
+        This function puts the chunks of a download in a task queue, which is a priority queue. Two schemes are supported: 'rarest_first' and 'normal'
+
+        rarest_first: number of addresses available for the chunk is used as the key. Ties are broken in random order, so that peers downloading the same file at the same time fetch different chunks and can serve them to each other
 
         normal: chunkid is used as the key. They are basically incremental
+
+        Chunks the download already has, e.g. when it is resumed, are left out. Keys start at `start`, so that the chunks of several files can share one queue; files queued later come after in 'normal' order. Tasks of a `batch` download leave the other files going when they fail.
+
+        @return the key to start the next file at
         """
 
-        task_queue = PriorityQueue()
+        filename = download.filename
+        chunkid_to_addresses = download.chunkid_to_addresses
+        chunkid_to_md5 = download.chunkid_to_md5
         if scheme == 'rarest_first':
-            counter = 0
-            for key, value in chunkid_to_addresses.items():
+            chunkids = [chunkid for chunkid in chunkid_to_addresses if chunkid not in download.have]
+            random.shuffle(chunkids)
+            for counter, key in enumerate(chunkids, start):
+                value = chunkid_to_addresses[key]
                 task_queue.put((len(value), counter, {
                     'addresses': value,
                     'filename': filename,
                     'chunkid': key,
-                    'md5': chunkid_to_md5[key],
-                    'scheme': scheme,
-                }))
-                counter += 1
-        else:
-            for i, chunkid in enumerate(sorted([key for key in chunkid_to_md5])):
-                task_queue.put((i, 0, {
-                    'addresses': chunkid_to_addresses[chunkid],
-                    'filename': filename,
-                    'chunkid': chunkid,
-                    'md5': chunkid_to_md5[chunkid],
+                    'md5': chunkid_to_md5.get(key),
                     'scheme': scheme,
-                    'num_retries_left': protocol.CHUNK_RETRY_LIMIT,
+                    'download': download,
+                    'batch': batch,
                 }))
-        return task_queue
+            return start + len(chunkids)
+        chunkids = sorted([key for key in chunkid_to_addresses if key not in download.have])
+        for i, chunkid in enumerate(chunkids, start):
+            task_queue.put((i, 0, {
+                'addresses': chunkid_to_addresses[chunkid],
+                'filename': filename,
+                'chunkid': chunkid,
+                'md5': chunkid_to_md5.get(chunkid),
+                'scheme': scheme,
+                'num_retries_left': protocol.CHUNK_RETRY_LIMIT,
+                'download': download,
+                'batch': batch,
+            }))
+        return start + len(chunkids)
 
     def handler_download(self, args):
         """
@@ -323,59 +974,213 @@ class Peer(Node):
             'filename': 'f1.txt',
             'chunkid': 0
         }
+
+        returns: the chunk, as a FileRegion of the shared file so that it is sent with sendfile. b'' if this peer does not have the chunk.
+
+        For several chunks in one request, args has 'chunkids' (e.g. [0, 1, 5]) or 'range' (e.g. [0, 16], end excluded) instead of 'chunkid'. Only the first CHUNKS_PER_REQUEST of them are sent, and a request with a chunk id that is not an int the chunk header can hold is rejected.
+
+        returns: a Stream with one 'chunk' frame per chunk, in the requested order. Each frame starts with the chunk id.
+
+        With 'proof': True, for files in Merkle integrity mode, the chunk id in each frame is followed by the proof of the chunk (see merkle.pack_proof). A chunk whose proof is not known is sent as not there.
         """
-        chunk_path = self.__get_chunk_path(args['filename'], args['chunkid'])
-        if not exists(chunk_path):
-            return b''
-        with open(chunk_path, 'rb') as f:
-            return f.read()
+        if 'chunkids' in args or 'range' in args:
+            if 'chunkids' in args:
+                chunkids = list(args['chunkids'][:protocol.CHUNKS_PER_REQUEST])
+            else:
+                first, end = args['range']
+                chunkids = [first, end]
+            if not all(is_chunkid(chunkid) for chunkid in chunkids):
+                raise ValueError('Invalid chunk ids in a download request: {}'.format(args.get('chunkids', args.get('range'))))
+            if 'range' in args:
+                chunkids = range(first, min(end, first + protocol.CHUNKS_PER_REQUEST))
+            return Stream(protocol.FRAME_TYPES['chunk'], (
+                self.__get_chunk(args['filename'], chunkid, CHUNK_HEADER.pack(chunkid), args.get('proof')) for chunkid in chunkids
+            ))
+        if not is_chunkid(args['chunkid']):
+            raise ValueError('Invalid chunk id in a download request: {}'.format(args['chunkid']))
+        return self.__get_chunk(args['filename'], args['chunkid'])
 
-    def __combine_chunks_to_file(self, destination, filename, chunkids):
-        with open(destination, 'wb') as f:
-            for chunkid in chunkids:
-                with open(self.__get_chunk_path(filename, chunkid), 'rb') as g:
-                    f.write(g.read())
+    def handler_have(self, args):
+        """
+        Tell another peer which chunks of a file this peer has, and learn which it has. The asker sends its bitmap with its first request only, and gets the bitmap of this peer.
 
-    def __check_md5_equal(self, filename, chunkids, target_md5):
-        md5_full = hashlib.md5()
-        for chunkid in chunkids:
-            with open(self.__get_chunk_path(filename, chunkid), 'rb') as f:
-                md5_full.update(f.read())
-        return md5_full == target_md5
+        args = {
+            'address': '168.0.0.3:4444',
+            'filename': 'f1.txt',
+            'bitmap': 'ff01',
+            'since': None
+        }
 
-    def __check_bytes_equal(self, filepath, target_bytes):
-        return os.stat(filepath).st_size == target_bytes
+        returns: {
+            'version': 3,
+            'bitmap': 'ff03',
+            'peers': ['127.0.0.3:4321']
+        }
 
-    def __get_md5_from_data(self, data):
-        return hashlib.md5(data).hexdigest()
+        From then on, the asker sends the version it knows, and gets the chunks this peer has added since, oldest first. As with 'loc_delta', if there are none yet the response waits for up to 'wait' seconds (at most SUBSCRIBE_WAIT) for one.
 
-    def __get_md5_from_file(self, filepath):
-        md5_full = hashlib.md5()
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(protocol.BYTES_PER_CHUNK), b''):
-                md5_full.update(chunk)
-        return md5_full.hexdigest()
+        args = {
+            'address': '168.0.0.3:4444',
+            'filename': 'f1.txt',
+            'since': 3,
+            'wait': 10
+        }
 
-    def __get_chunks_md5_from_file(self, filepath):
-        md5_chunks = []
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(protocol.BYTES_PER_CHUNK), b''):
-                md5_chunks.append(self.__get_md5_from_data(chunk))
-        return md5_chunks
+        returns: {
+            'version': 5,
+            'chunks': [9, 4],
+            'peers': ['127.0.0.3:4321']
+        }
 
-    def __get_chunk_path(self, filename, chunkid):
-        parent = join(self.tmp_dir, filename)
-        if not exists(parent):
-            os.system('mkdir -p {}'.format(parent))
-        return join(parent, str(chunkid) + '.chunk')
+        'peers' are other peers known to hold chunks of the file. The whole bitmap is sent instead of 'chunks' when the chunks since 'since' are not remembered anymore. 'version' is None if this peer does not share the file.
+        """
+        filename = args['filename']
+        shared_file = self.__shared_files.get(filename)
+        if not shared_file:
+            return { 'version': None }
+        have_log = shared_file['have_log']
+        asker = args['address']
+        downloading = self.__exchanges.get(filename)
+        if args.get('bitmap') is not None:
+            have_log.learn(asker)
+            if downloading:
+                # The asker is downloading the same file: what it has can be downloaded from it
+                download, exchange = downloading
+                self.__add_holder(download, asker, Bitfield.from_bytes(download.num_chunks, bytes.fromhex(args['bitmap'])))
+                exchange.learn([asker])
+                exchange.refill()
 
-    def __split_file_into_chunks(self, filepath):
+        changes = None
+        if args.get('since') is not None:
+            wait = min(float(args.get('wait') or 0), protocol.SUBSCRIBE_WAIT)
+            if wait > 0 and not self.__waiters.acquire(blocking=False):
+                wait = 0
+            try:
+                changes = have_log.changes(args['since'], wait)
+            finally:
+                if wait > 0:
+                    self.__waiters.release()
+        if have_log.closed:
+            return { 'version': None }
+        if changes is None:
+            version, bitmap = have_log.bitmap()
+            response = { 'version': version, 'bitmap': bitmap.hex() }
+        else:
+            response = { 'version': changes[0], 'chunks': changes[1] }
+        peers = have_log.known(protocol.PEER_EXCHANGE_PEERS)
+        if downloading:
+            peers += downloading[1].known(protocol.PEER_EXCHANGE_PEERS)
+        response['peers'] = [address for address in dict.fromkeys(peers) if address != asker][:protocol.PEER_EXCHANGE_PEERS]
+        return response
+
+    def __get_chunk(self, filename, chunkid, prefix=b'', with_proof=False):
+        shared_file = self.__shared_files.get(filename)
+        if not shared_file:
+            return prefix
+        offset = chunkid * shared_file['bytes_per_chunk']
+        if chunkid < 0 or offset >= shared_file['bytes']:
+            return prefix
+        if shared_file['have'] is not None and chunkid not in shared_file['have']:
+            return prefix
+        if with_proof:
+            proof = shared_file['proof'](chunkid) if shared_file['proof'] else None
+            if proof is None:
+                return prefix
+            prefix += pack_proof(proof)
+        return FileRegion(self.__open_files, shared_file['filepath'], offset, min(shared_file['bytes_per_chunk'], shared_file['bytes'] - offset), prefix)
+
+    def __share_file(self, filename, filepath, file_bytes, bytes_per_chunk, have=None, proof=None):
+        """
+        Start serving chunks of a file. `have` is the Bitfield of chunks written so far if the file is still being downloaded, or None if the whole file is there. `proof` gives the Merkle proof of a chunk id for files in Merkle integrity mode.
+        """
+        previous = self.__shared_files.get(filename)
+        # Peers keep following the same log when a downloaded file is shared again from start to end
+        have_log = previous['have_log'] if previous else HaveLog((file_bytes + bytes_per_chunk - 1) // bytes_per_chunk)
+        have_log.have = have
+        self.__shared_files[filename] = {
+            'filepath': filepath,
+            'bytes': file_bytes,
+            'bytes_per_chunk': bytes_per_chunk,
+            'have': have,
+            'proof': proof,
+            'have_log': have_log,
+        }
+        if previous and previous['filepath'] != filepath:
+            self.__open_files.forget(previous['filepath'])
+
+    def __unshare_file(self, filename):
+        shared_file = self.__shared_files.pop(filename, None)
+        if shared_file:
+            shared_file['have_log'].close()
+            self.__open_files.forget(shared_file['filepath'])
+
+    def __get_md5_from_data(self, data, algorithm=hashing.DEFAULT_ALGORITHM):
+        return hashing.hexdigest(algorithm, data)
+
+    def __choose_bytes_per_chunk(self, file_bytes):
+        """
+        Pick the smallest power of two between MIN_BYTES_PER_CHUNK and MAX_BYTES_PER_CHUNK that splits the file into at most TARGET_CHUNKS_PER_FILE chunks. Files up to 1 MiB keep the 1 KiB chunks.
+        """
+        bytes_per_chunk = protocol.MIN_BYTES_PER_CHUNK
+        while bytes_per_chunk < protocol.MAX_BYTES_PER_CHUNK and bytes_per_chunk * protocol.TARGET_CHUNKS_PER_FILE < file_bytes:
+            bytes_per_chunk *= 2
+        return bytes_per_chunk
+
+    def __scan_file(self, filepath, bytes_per_chunk=None, algorithm=hashing.DEFAULT_ALGORITHM):
+        """
+        Compute the md5 of the whole file and of every chunk in one pass over the file, unless the manifest has them from an earlier scan of the same file. With another hash `algorithm`, the 'md5' fields hold its digests instead. Example:
+
+        input: 'test_files/1392bytes.txt', None, 'md5'
+        output: {
+            'filename': '1392bytes.txt',
+            'filepath': 'test_files/1392bytes.txt',
+            'bytes': 1392,
+            'bytes_per_chunk': 1024,
+            'hash': 'md5',
+            'md5_full': 'e22428ccf96cda9674a939c209ad1000',
+            'md5_chunks': ['03c7c0ace395d80182db07ae2c30f034', '4b43b0aee35624cd95b910189b3dc231']
+        }
+        """
         filename = filepath.split('/')[-1]
+        stat = os.stat(filepath)
+        file_bytes = stat.st_size
+        bytes_per_chunk = bytes_per_chunk or self.__choose_bytes_per_chunk(file_bytes)
+        entry = self.__manifest.get(filepath, bytes_per_chunk, algorithm)
+        if entry:
+            return {
+                'filename': filename,
+                'filepath': filepath,
+                'bytes': file_bytes,
+                'bytes_per_chunk': bytes_per_chunk,
+                'hash': algorithm,
+                'md5_full': entry['md5_full'],
+                'md5_chunks': entry['md5_chunks'],
+            }
+
+        md5_full = hashing.new(algorithm)
+        md5_chunks = []
+
+        # Read a whole number of chunks at a time so that the md5 of the whole file is updated with large blocks, during which hashlib releases the GIL
+        block = bytearray(max(1, protocol.READ_BLOCK_BYTES // bytes_per_chunk) * bytes_per_chunk)
+        view = memoryview(block)
         with open(filepath, 'rb') as f:
-            for chunkid, chunk in enumerate(iter(lambda: f.read(protocol.BYTES_PER_CHUNK), b'')):
-                local_chunk_path = self.__get_chunk_path(filename, chunkid)
-                with open(local_chunk_path, 'wb') as g:
-                    g.write(chunk)
+            while True:
+                n = f.readinto(block)
+                if not n:
+                    break
+                md5_full.update(view[:n])
+                for offset in range(0, n, bytes_per_chunk):
+                    md5_chunks.append(self.__get_md5_from_data(view[offset:min(offset + bytes_per_chunk, n)], algorithm))
+        self.__manifest.put(filepath, stat, bytes_per_chunk, md5_full.hexdigest(), md5_chunks, algorithm)
+        return {
+            'filename': filename,
+            'filepath': filepath,
+            'bytes': file_bytes,
+            'bytes_per_chunk': bytes_per_chunk,
+            'hash': algorithm,
+            'md5_full': md5_full.hexdigest(),
+            'md5_chunks': md5_chunks,
+        }
 
     def command_generator(self, **kwargs):
         if not kwargs.get('auto_mode'):
@@ -433,6 +1238,8 @@ if __name__ == '__main__':
     parser.add_argument('-dpr', '--dynamic_port_range', required=True)
     parser.add_argument('-t', '--num_download_threads', required=True)
     parser.add_argument('-n', '--name', help='name of this peer. it will be used as the tmp dir name')
+    parser.add_argument('-e', '--engine', choices=protocol.ENGINES, default='thread', help='"thread" serves each connection on its own thread, "asyncio" serves all connections from one event loop')
+    parser.add_argument('-z', '--compression', help='comma separated codecs to ask other nodes to compress responses with, preferred first: zlib, lzma, bz2. Off by default')
 
     parser.add_argument('-a', '--auto_mode', action='store_true', help='if this is specified, the program does not for user input; it will use the configured command file to run')
     parser.add_argument('-c', '--command_file', help='(only available at auto mode) the command file to use')
@@ -447,6 +1254,8 @@ if __name__ == '__main__':
         dynamic_port_range=args.dynamic_port_range,
         num_download_threads=args.num_download_threads,
         name=args.name,
+        engine=args.engine,
+        compression=args.compression,
     )
     peer.run(
         auto_mode=args.auto_mode,
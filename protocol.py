@@ -1,21 +1,126 @@
+# Chunk size of files registered without one (and of every file registered before chunk size became per file)
 BYTES_PER_CHUNK = 1024
+# Registration picks the smallest power of two in this range that keeps a file under TARGET_CHUNKS_PER_FILE chunks
+MIN_BYTES_PER_CHUNK = 1024
+MAX_BYTES_PER_CHUNK = 4 * 1024 * 1024
+TARGET_CHUNKS_PER_FILE = 1024
+# Files are read in blocks of about this size (rounded to a whole number of chunks) when they are scanned
+READ_BLOCK_BYTES = 1024 * 1024
 BUFF_SIZE = 4096
 CHUNK_RETRY_LIMIT = 5
+# Downloaded chunks are announced to the server in batches of up to ANNOUNCE_BATCH_SIZE, at least every ANNOUNCE_INTERVAL seconds
+ANNOUNCE_BATCH_SIZE = 256
+ANNOUNCE_INTERVAL = 0.5
+# A download worker asks one peer for up to CHUNKS_PER_REQUEST chunks per request, and keeps up to PIPELINE_DEPTH such requests in flight
+CHUNKS_PER_REQUEST = 16
+PIPELINE_DEPTH = 4
+# Requests in flight to one peer, from all download threads together
+MAX_REQUESTS_PER_PEER = 16
+# Weight of the newest sample in the moving average of peer throughput
+SCHEDULER_SMOOTHING = 0.3
+# Seconds a download thread waits before looking again when every peer that has its chunk is at its cap
+SCHEDULER_WAIT = 0.1
+# Endgame: once fewer chunks are missing than the download threads can have in flight at once, idle threads ask other holders for chunks already in flight, up to this many extra requests per chunk
+ENDGAME_MAX_DUPLICATES = 2
+# Seconds a download thread waits for a task before it looks for endgame work
+WORKER_POLL_INTERVAL = 0.1
+# Shards of the tracker index, each with its own lock
+TRACKER_SHARDS = 16
+# Files in one page of 'list' when the client does not ask for a number, and the most it can ask for
+LIST_PAGE_SIZE = 1000
+LIST_MAX_PAGE_SIZE = 10000
+# Bytes of encoded 'loc' responses the tracker keeps to answer the same query again while the file has not changed
+LOC_CACHE_BYTES = 64 * 1024 * 1024
+# Chunks a downloader asks 'loc' about per request
+LOC_RANGE_CHUNKS = 65536
+# Files located per 'loc_batch' request
+LOC_BATCH_FILES = 1000
+# Files a batch download has open at once. The next ones are started as these finish
+BATCH_ACTIVE_FILES = 256
+# Changes to the holders of a file the tracker remembers for 'loc_delta'. A downloader further behind gets the whole 'loc' again
+TRACKER_CHANGE_LOG_LENGTH = 4096
+# Records the tracker appends to its log before it writes a new snapshot and starts the log over
+TRACKER_SNAPSHOT_RECORDS = 1000000
+# Seconds at least between two refreshes of chunk availability during a download, so that changes arriving one by one are fetched in batches
+AVAILABILITY_REFRESH_INTERVAL = 1.0
+# Seconds a 'loc_delta' waits at most for a change before it answers with none. Must stay well below REQUEST_TIMEOUT
+SUBSCRIBE_WAIT = 10
+# 'loc_delta' and 'have' requests a node lets wait at once, and never more than half of its request workers, so that waiting never takes every one of them. Any more are answered right away
+SUBSCRIBE_MAX_WAITERS = 32
+# Peers a download exchanges have-bitmaps with at once
+PEER_EXCHANGE_PARTNERS = 4
+# Addresses of other holders a peer sends along in a 'have' response, for the asker to find more partners
+PEER_EXCHANGE_PEERS = 32
+# Shared files a peer keeps open to send chunks from. The least recently used are closed beyond that, and opened again when asked for
+PEER_OPEN_FILES = 256
+# New chunks a peer remembers for 'have'. A partner further behind gets the whole bitmap again
+PEER_HAVE_LOG_LENGTH = 4096
+# Seconds between two saves of which chunks a download has, for resuming it after a crash
+DOWNLOAD_STATE_INTERVAL = 1.0
+# Payloads shorter than this are never compressed
+COMPRESSION_MIN_BYTES = 512
+# A compressed payload is sent only if it is at most this fraction of the original
+COMPRESSION_MAX_RATIO = 0.9
+# Frames in a row of one response that did not compress before the rest of it is sent without trying
+COMPRESSION_GIVE_UP = 4
+REQUEST_TIMEOUT = 30
+LISTEN_BACKLOG = 1024
+# Connections the 'thread' engine serves at once, each with its own thread. Connections accepted beyond that are answered 'busy' and closed
+MAX_CONNECTIONS = 1024
+# Same for the 'asyncio' engine, where a connection costs no thread and the limit is the number of open files
+ASYNC_MAX_CONNECTIONS = 65536
+# Seconds a connection answered 'busy' is kept open for the client to read the answer and close it first
+BUSY_LINGER = 1.0
+# Requests a node handles at once: worker threads of the 'thread' engine, threads for blocking handlers of the 'asyncio' engine
+REQUEST_WORKERS = 64
+# Requests a node accepts on top of those it is handling, waiting for a worker. Any more are answered 'busy' straight away
+REQUEST_QUEUE_LIMIT = 256
+# Seconds a busy node asks clients to wait before they try it again
+BUSY_RETRY_AFTER = 0.2
+# Times a request answered 'busy' is tried again by Node.request before NodeBusy is raised
+BUSY_RETRIES = 5
+ENGINES = ['thread', 'asyncio']
 
+# Every message on the wire is one frame: a fixed header followed by `length` bytes of payload.
+# Header fields: version, frame type, flags, request id, length
+FRAME_HEADER_FORMAT = '!BBHII'
+FRAME_VERSION = 1
+FRAME_MAX_BYTES = 1 << 30
+# Frame type of a message, keyed by the 'type_request' / 'type_response' values used in COMMANDS
+FRAME_TYPES = {
+    'json': 1,
+    'byte': 2,
+    # A chunk in a multi-chunk download: a CHUNK_HEADER_FORMAT chunk id followed by the chunk (empty if the peer does not have it)
+    'chunk': 3,
+    # Sent by a client with the id of one of its requests to stop the response to it, e.g. the rest of a stream. Empty payload, never answered
+    'cancel': 4,
+    # Sent by a client first thing on a new connection: {"codecs": [codec1, codec2]}, the codecs (see compression.CODECS) responses may be compressed with, preferred first. Never answered
+    'hello': 5,
+    # Answer to a request the node has no room for: {"retry_after": seconds}. The request was not handled. With request id 0, the node has no room for the connection itself, and closes it
+    'busy': 6,
+}
+# Set on every frame of a streamed response. The stream ends with one frame without it
+FRAME_FLAG_MORE = 1
+# The flags above this shift hold the id of the codec the payload is compressed with, 0 if it is not
+FRAME_CODEC_SHIFT = 8
+CHUNK_HEADER_FORMAT = '!I'
+
+# 'blocking': the handler waits on disk (the tracker logs every registration when it keeps them with -d), on other nodes or for changes, so the asyncio engine runs it on a thread instead of on the event loop
 COMMANDS = {
     'reg_file': {
         'available_node_types': 'peer',
-        'args': '{"files": [filepath1, filepath2]}',
-        'help': 'register files by file paths',
+        'args': '{"files": [filepath1, filepath2], "bytes_per_chunk": bytes_per_chunk, "integrity": "md5", "hash": "md5"}',
+        'help': 'register files by file paths. The "bytes_per_chunk" argument is optional; by default it is chosen from the size of each file. "integrity" is optional: "md5" (default) sends the digest of every chunk, "merkle" only the root of a hash tree over them, and chunks are then sent with proofs. "hash" is optional: the algorithm chunks are hashed with, "md5" (default), "blake2b" or "blake2s", or "xxh3_128" / "blake3" where those packages are installed',
         'request_to': 'server',
         'handler': 'handler_register_file',
         'type_request': 'json',
-        'type_response': 'json'
+        'type_response': 'json',
+        'blocking': True
     },
     'list': {
         'available_node_types': 'peer',
-        'args': '{}',
-        'help': 'list files available',
+        'args': '{"prefix": prefix, "min_bytes": min_bytes, "max_bytes": max_bytes, "limit": limit, "cursor": cursor}',
+        'help': 'list files available, by name, one page at a time. Every argument is optional: "prefix" and "min_bytes" / "max_bytes" filter the files, "limit" is the page size, and "cursor" is the "next" of the previous page',
         'request_to': 'server',
         'handler': 'handler_file_list',
         'type_request': 'json',
@@ -23,13 +128,32 @@ COMMANDS = {
     },
     'loc': {
         'available_node_types': 'peer',
-        'args': '{"filename": filename, "include_md5": false}',
-        'help': 'get ip of peers that contain the requested file name. The "include_md5" argument is optional',
+        'args': '{"filename": filename, "include_md5": false, "range": [first, end]}',
+        'help': 'get ip of peers that contain the requested file name. The "include_md5" argument is optional. "range" is optional: only chunks first to end (excluded) are listed',
         'request_to': 'server',
         'handler': 'handler_file_locations',
         'type_request': 'json',
         'type_response': 'json'
     },
+    'loc_delta': {
+        'available_node_types': 'peer',
+        'args': '{"filename": filename, "since": version, "wait": seconds}',
+        'help': 'get the changes to the peers holding a file since a version returned by "loc" or "loc_delta". With "wait", the server answers only once there is a change or after that many seconds',
+        'request_to': 'server',
+        'handler': 'handler_file_location_changes',
+        'type_request': 'json',
+        'type_response': 'json',
+        'blocking': True
+    },
+    'loc_batch': {
+        'available_node_types': 'peer',
+        'args': '{"filenames": [filename1, filename2], "pattern": pattern, "include_md5": false, "cursor": cursor}',
+        'help': 'get what "loc" returns for several files at once: those in "filenames", or those whose name matches the glob "pattern", one page at a time with "cursor" as for "list"',
+        'request_to': 'server',
+        'handler': 'handler_file_locations_batch',
+        'type_request': 'json',
+        'type_response': 'json'
+    },
     'reg_chunk': {
         'available_node_types': 'peer',
         'args': '{"filename": filename, "chunkid": chunkid}, "md5": chunk_md5',
@@ -37,7 +161,18 @@ COMMANDS = {
         'request_to': 'server',
         'handler': 'handler_register_chunk',
         'type_request': 'json',
-        'type_response': 'json'
+        'type_response': 'json',
+        'blocking': True
+    },
+    'reg_chunks': {
+        'available_node_types': 'peer',
+        'args': '{"chunks": [[filename, chunkid, chunk_md5], [filename, chunkid, chunk_md5]]}',
+        'help': 'register many chunks at once',
+        'request_to': 'server',
+        'handler': 'handler_register_chunks',
+        'type_request': 'json',
+        'type_response': 'json',
+        'blocking': True
     },
     'leave': {
         'available_node_types': 'peer',
@@ -46,16 +181,37 @@ COMMANDS = {
         'request_to': 'server',
         'handler': 'handler_leave',
         'type_request': 'json',
-        'type_response': 'json'
+        'type_response': 'json',
+        'blocking': True
     },
     'download': {
         'available_node_types': 'peer',
         'args': '{"filename": filename, "destination": destination, "scheme": scheme}',
+        # Between peers, args are either {"filename", "chunkid"} for one chunk, or {"filename", "chunkids": [chunkid1, chunkid2]} / {"filename", "range": [first, end]} for a stream of chunks, with "proof": true to get the Merkle proof of every chunk
         'help': 'download file by filename. scheme can be either "normal" or "rarest_first"',
         'request_to': 'peer',
         'handler': 'handler_download',
         'type_request': 'json',
-        'type_response': 'byte'
+        'type_response': 'byte',
+        'blocking': True
+    },
+    'have': {
+        'available_node_types': 'peer',
+        'args': '{"filename": filename, "bitmap": hex_bitmap, "since": version, "wait": seconds}',
+        # Sent by downloads to other peers, not from the command line
+        'help': 'exchange which chunks of a file two peers have: the asker sends its bitmap first, and gets the bitmap of the other peer, then only the chunks it added since "since", waiting up to "wait" seconds for one',
+        'request_to': 'peer',
+        'handler': 'handler_have',
+        'type_request': 'json',
+        'type_response': 'json',
+        'blocking': True
+    },
+    'download_batch': {
+        'available_node_types': 'peer',
+        'args': '{"filenames": [filename1, filename2], "pattern": pattern, "destination": directory, "scheme": scheme}',
+        # Run by this peer only: the files are located with one "loc_batch" and their chunks downloaded with "download"
+        'help': 'download several files into a directory: those in "filenames", or those whose name matches the glob "pattern". Chunks of every file are downloaded by one pool of download threads. scheme can be either "normal" or "rarest_first"',
+        'request_to': 'peer',
     },
     'inspect': {
         'available_node_types': 'server,peer',
@@ -70,3 +226,17 @@ COMMANDS = {
 
 class DownloadFail(Exception):
     pass
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class NodeBusy(ConnectionClosed):
+    """
+    The other node answered 'busy' instead of handling a request. It asks to be tried again after `retry_after` seconds.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
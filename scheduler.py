@@ -0,0 +1,110 @@
+from threading import Condition
+from time import time
+
+import protocol
+
+
+class PeerScheduler:
+    """
+    Decides which peer a download worker asks for chunks, based on what was observed from every remote address so far:
+
+    throughput: moving average of bytes per second over whole requests, from when a request is sent to its last chunk, so a peer that is slow to answer scores lower as well as one that is slow to send
+    failures: consecutive failed requests, halving the score of the peer each time
+    in_flight: requests sent to the peer and not answered yet, capped at `max_in_flight`
+    busy_until: a peer that answered 'busy' is not picked again before this time, unless every candidate is busy
+
+    A peer is scored by its throughput divided among the requests it already has in flight. Peers nothing is known about yet are tried first, so that every seeder gets measured.
+
+    self.__peers = {
+        '127.0.0.1:3029': {
+            'throughput': 2500000.0,
+            'failures': 0,
+            'in_flight': 3,
+            'busy_until': 0,
+        }
+    }
+    """
+
+    def __init__(self, max_in_flight=protocol.MAX_REQUESTS_PER_PEER):
+        self.__max_in_flight = max_in_flight
+        self.__peers = {}
+        self.__condition = Condition()
+
+    def acquire(self, candidates, num_requests):
+        """
+        Pick the best of `candidates` (addresses) and reserve up to `num_requests` request slots on it. Blocks while every candidate is at its cap or backing off after a 'busy' answer.
+
+        @return the address and the number of slots reserved, at least 1
+        """
+        with self.__condition:
+            while True:
+                now = time()
+                best = None
+                best_score = None
+                wait = protocol.SCHEDULER_WAIT
+                for address in candidates:
+                    stats = self.__get_stats(address)
+                    if stats['in_flight'] >= self.__max_in_flight:
+                        continue
+                    if stats['busy_until'] > now:
+                        wait = min(wait, stats['busy_until'] - now)
+                        continue
+                    score = self.__score(stats)
+                    if best is None or score > best_score:
+                        best, best_score = address, score
+                if best is not None:
+                    stats = self.__peers[best]
+                    reserved = min(num_requests, self.__max_in_flight - stats['in_flight'])
+                    stats['in_flight'] += reserved
+                    return best, reserved
+                self.__condition.wait(wait)
+
+    def release(self, address, num_bytes, elapsed, failed, retry_after=None):
+        """
+        Give back the slot of one request and record how it went. `retry_after` is the delay a peer that answered 'busy' asked for; it is not a failure, the peer is only left alone for that long.
+        """
+        with self.__condition:
+            stats = self.__get_stats(address)
+            stats['in_flight'] -= 1
+            if retry_after is not None:
+                stats['busy_until'] = max(stats['busy_until'], time() + retry_after)
+            elif failed:
+                stats['failures'] += 1
+            else:
+                stats['failures'] = 0
+                if elapsed > 0:
+                    stats['throughput'] = self.__average(stats['throughput'], num_bytes / elapsed)
+            self.__condition.notify_all()
+
+    def give_back(self, address, num_requests=1):
+        """
+        Give back slots that were reserved and not used, e.g. for a request that turned out to have nothing to ask for. Nothing is recorded about the peer.
+        """
+        with self.__condition:
+            self.__get_stats(address)['in_flight'] -= num_requests
+            self.__condition.notify_all()
+
+    def stats(self, address):
+        with self.__condition:
+            return dict(self.__get_stats(address))
+
+    def __get_stats(self, address):
+        if address not in self.__peers:
+            self.__peers[address] = {
+                'throughput': None,
+                'failures': 0,
+                'in_flight': 0,
+                'busy_until': 0,
+            }
+        return self.__peers[address]
+
+    def __score(self, stats):
+        if stats['throughput'] is None:
+            return float('inf')
+        return stats['throughput'] / (stats['in_flight'] + 1) * 0.5 ** stats['failures']
+
+    @staticmethod
+    def __average(previous, sample):
+        if previous is None:
+            return sample
+        return (1 - protocol.SCHEDULER_SMOOTHING) * previous + protocol.SCHEDULER_SMOOTHING * sample
@@ -1,34 +1,45 @@
+import re
 import json
-import heapq
-from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from fnmatch import fnmatchcase
 from traceback import print_exc
 from socket import socket
-from threading import Thread
+from threading import BoundedSemaphore, Lock, Thread
+from time import time
 
+import hashing
+import protocol
 from node import Node
+from tracker import MD5_BYTES, TrackerIndex
+from tracker_store import TrackerStore
 
 
 class Server(Node):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.files = {}
-        """
-        self.files = {
-            'f1.txt': {
-                'bytes': 444,
-                'md5': '03c7c0ace395d80182db07ae2c30f034',
-                'chunks': [{
-                    'peers': { '168.0.0.1:4444': True },
-                    'md5': '4b43b0aee35624cd95b910189b3dc231',
-                    'id': 0,
-                }, {
-                    'peers': { '168.0.0.1:4444': True, '153.43.44.2:5311': True },
-                    'md5': 'e22428ccf96cda9674a939c209ad1000',
-                    'id': 1,
-                }]
-            }
-        }
-        """
+        self.index = TrackerIndex()
+
+        # Sorted catalog for 'list', with the catalog version of the index it was built at
+        self.__catalog = (None, [], [])
+        # Encoded 'loc' responses by (filename, include_md5, range), each with the (serial, version) of the file it was built from. Least recently used first
+        self.__loc_cache = OrderedDict()
+        self.__loc_cache_bytes = 0
+        self.__cache_lock = Lock()
+        # Slots for 'loc_delta' requests waiting for a change
+        self.__waiters = BoundedSemaphore(self._max_waiters)
+
+        # With a data directory, registrations survive restarts: the index is loaded from there and every change is logged to it
+        self.store = None
+        # Writes snapshots, so that the request that fills the log does not wait for one
+        self.__snapshot_thread = None
+        self.__snapshot_lock = Lock()
+        if kwargs.get('data_dir'):
+            self.store = TrackerStore(kwargs['data_dir'])
+            start = time()
+            num_files = self.store.load(self.index)
+            self.index.journal = self.store
+            self._logger.info('Loaded {} files from {} in {:.2f}s'.format(num_files, self.store.directory, time() - start))
 
     def handler_register_file(self, args):
         """
@@ -37,11 +48,14 @@ class Server(Node):
             'files': [{
                 'filename': 'f1.txt',
                 'bytes': 444,
+                'bytes_per_chunk': 1024,
                 'md5_full': 'e22428ccf96cda9674a939c209ad1000'
                 'md5_chunks': ['03c7c0ace395d80182db07ae2c30f034', '4b43b0aee35624cd95b910189b3dc231']
             }]
         }
 
+        A file in Merkle integrity mode has 'merkle_root' and 'num_chunks' instead of 'md5_chunks'. A file hashed with another algorithm than md5 (see hashing.ALGORITHMS) has its name in 'hash', and its 'md5' fields hold digests of that algorithm. Files with an algorithm the tracker cannot store are not registered.
+
         returns: [{
             'f1.txt': True,
             'f2.txt': True,
@@ -51,53 +65,102 @@ class Server(Node):
         address = args['address']
         result = []
         for entry in args['files']:
-            if entry['filename'] in self.files:
-                # for chunk in self.files[entry['filename']]['chunks']:
-                #     chunk['peers'][address] = True
+            algorithm = entry.get('hash', hashing.DEFAULT_ALGORITHM)
+            if algorithm not in hashing.ALGORITHM_IDS:
                 result.append({ entry['filename']: False })
-            else:
-                self.files[entry['filename']] = {
-                    'bytes': entry['bytes'],
-                    'md5': entry['md5_full'],
-                    'chunks': [{
-                        'peers': { address: True },
-                        'md5': md5_chunk,
-                        'id': i,
-                    } for i, md5_chunk in enumerate(entry['md5_chunks'])],
-                }
-                result.append({ entry['filename']: True })
+                continue
+            registered = self.index.add_file(
+                entry['filename'],
+                entry['bytes'],
+                entry.get('bytes_per_chunk', protocol.BYTES_PER_CHUNK),
+                entry['md5_full'],
+                entry.get('md5_chunks', []),
+                address,
+                merkle_root=entry.get('merkle_root'),
+                num_chunks=entry.get('num_chunks'),
+                algorithm=algorithm,
+            )
+            result.append({ entry['filename']: registered })
+        self.__save()
         return result
 
     def handler_file_list(self, args):
         """
+        One page of the files in the network, sorted by name. Every argument but 'address' is optional.
+
         args = {
-            'address': '168.0.0.3:4444'
+            'address': '168.0.0.3:4444',
+            'prefix': 'f',
+            'min_bytes': 100,
+            'max_bytes': 1000000,
+            'limit': 2,
+            'cursor': 'e9.txt'
         }
 
         returns: {
             'count': 2,
-            'result': ['f1.txt', 'f2.txt']
+            'result': [{'filename': 'f1.txt', 'bytes': 444}, {'filename': 'f2.txt', 'bytes': 2048}],
+            'next': 'f2.txt'
         }
+
+        'next' is the cursor of the next page, or None on the last one. Files that are added or removed between two pages show up or not depending on their name.
         """
+        names, sizes = self.__get_catalog()
+        prefix = args.get('prefix') or ''
+        min_bytes = args.get('min_bytes') or 0
+        max_bytes = args.get('max_bytes')
+        limit = max(1, min(int(args.get('limit') or protocol.LIST_PAGE_SIZE), protocol.LIST_MAX_PAGE_SIZE))
+
+        i = bisect_left(names, prefix)
+        if args.get('cursor') is not None:
+            i = max(i, bisect_right(names, args['cursor']))
+        result = []
+        while i < len(names) and names[i].startswith(prefix) and len(result) < limit:
+            if sizes[i] >= min_bytes and (max_bytes is None or sizes[i] <= max_bytes):
+                result.append({
+                    'filename': names[i],
+                    'bytes': sizes[i],
+                })
+            i += 1
+        more = i < len(names) and names[i].startswith(prefix)
         return {
-            'count': len(self.files),
-            'result': [{
-                'filename': filename,
-                'bytes': self.files[filename]['bytes'],
-            } for filename in self.files],
+            'count': len(result),
+            'result': result,
+            'next': names[i - 1] if more else None,
         }
 
+    def __get_catalog(self):
+        """
+        @return the names of all files, sorted, and their sizes. Sorted once per version of the catalog, not per request
+        """
+        version = self.index.catalog_version
+        with self.__cache_lock:
+            if self.__catalog[0] == version:
+                return self.__catalog[1], self.__catalog[2]
+        files = sorted(self.index.list_files())
+        names = [filename for filename, _ in files]
+        sizes = [file_bytes for _, file_bytes in files]
+        with self.__cache_lock:
+            # Read before the files were listed, so the catalog is at least as new as this version
+            self.__catalog = (version, names, sizes)
+        return names, sizes
+
     def handler_file_locations(self, args):
         """
         args = {
             'address': '168.0.0.3:4444',
             'filename': 'f1.txt',
-            'include_md5': True
+            'include_md5': True,
+            'range': [0, 2]
         }
 
         returns: {
             'bytes': 444,
+            'bytes_per_chunk': 1024,
+            'num_chunks': 1,
             'md5': '03c7c0ace395d80182db07ae2c30f034',
+            'hash': 'md5',
+            'version': 7,
             'count': 1,
             'addresses': [{
                 'host': '127.0.0.3',
@@ -115,30 +178,179 @@ class Server(Node):
                 }]
             }]
         }
-        """
 
+        With a 'range' [first, end], only chunks first to end (excluded) are listed, and only the holders of any of them.
+
+        For a file registered by its Merkle root, the response has 'merkle_root' as well, and the chunks have no 'md5': they are checked against the root with the proof the serving peer sends along.
+
+        Encoded responses are cached with the version of the file they were built from, so asking again before anything changed about the file costs one lookup.
+        """
         filename = args['filename']
-        address_to_chunks = defaultdict(list)
-        if filename not in self.files:
+        include_md5 = bool(args.get('include_md5'))
+        chunk_range = tuple(args['range']) if args.get('range') else None
+        key = (filename, include_md5, chunk_range)
+        file_version = self.index.file_version(filename)
+        with self.__cache_lock:
+            cached = self.__loc_cache.get(key)
+            if cached is not None and cached[0] == file_version:
+                self.__loc_cache.move_to_end(key)
+                return cached[1]
+
+        record = self.index.get_file(filename)
+        if record is None:
             return { 'count': 0, 'addresses': [] }
-        for chunk in self.files[filename]['chunks']:
-            for address in chunk['peers']:
-                if args.get('include_md5'):
-                    address_to_chunks[address].append({
-                        'id': chunk['id'],
-                        'md5': chunk['md5'],
-                    })
-                else:
-                    address_to_chunks[address].append(chunk['id'])
+        response = self.encode_byte_json(self.__locate(record, include_md5, chunk_range))
+        with self.__cache_lock:
+            previous = self.__loc_cache.pop(key, None)
+            if previous is not None:
+                self.__loc_cache_bytes -= len(previous[1])
+            self.__loc_cache[key] = ((record['serial'], record['version']), response)
+            self.__loc_cache_bytes += len(response)
+            while self.__loc_cache_bytes > protocol.LOC_CACHE_BYTES and self.__loc_cache:
+                _, (_, evicted) = self.__loc_cache.popitem(last=False)
+                self.__loc_cache_bytes -= len(evicted)
+        return response
+
+    def handler_file_locations_batch(self, args):
+        """
+        What handler_file_locations returns, for up to LOC_BATCH_FILES files at once: those in 'filenames', or those whose name matches the glob 'pattern'. Every file is located for its first LOC_RANGE_CHUNKS chunks; its 'num_chunks' tells whether there are more to ask with 'loc'.
+
+        args = {
+            'address': '168.0.0.3:4444',
+            'filenames': ['f1.txt', 'f9.txt'],
+            'include_md5': True
+        }
+
+        returns: {
+            'count': 2,
+            'result': {
+                'f1.txt': {'bytes': 444, 'bytes_per_chunk': 1024, 'num_chunks': 1, ..., 'count': 1, 'addresses': [...]},
+                'f9.txt': {'count': 0, 'addresses': []}
+            },
+            'next': None
+        }
+
+        With 'pattern' (e.g. 'data/*.csv') instead of 'filenames', matching files are located in the order of their names, and 'next' is the 'cursor' of the next page, as with handler_file_list.
+        """
+        include_md5 = bool(args.get('include_md5'))
+        next_cursor = None
+        if args.get('pattern') is not None:
+            filenames, next_cursor = self.__match(args['pattern'], args.get('cursor'), protocol.LOC_BATCH_FILES)
+        else:
+            filenames = args.get('filenames', [])[:protocol.LOC_BATCH_FILES]
+        result = {}
+        for filename in filenames:
+            record = self.index.get_file(filename)
+            if record is None:
+                result[filename] = { 'count': 0, 'addresses': [] }
+            else:
+                result[filename] = self.__locate(record, include_md5, (0, protocol.LOC_RANGE_CHUNKS))
         return {
-            'bytes': self.files[filename]['bytes'],
-            'md5': self.files[filename]['md5'],
-            'count': len(address_to_chunks),
-            'addresses': [{
-                'host': key.split(':')[0],
-                'port': key.split(':')[1],
-                'chunks': address_to_chunks[key],
-            } for key in address_to_chunks],
+            'count': len(result),
+            'result': result,
+            'next': next_cursor,
+        }
+
+    def __match(self, pattern, cursor, limit):
+        """
+        @return up to `limit` names after `cursor` that match the glob `pattern`, and the cursor to go on from, or None if there are no more. Only the names starting with the part of the pattern before its first wildcard are looked at
+        """
+        names, _ = self.__get_catalog()
+        prefix = re.split(r'[*?[]', pattern, 1)[0]
+        i = bisect_left(names, prefix)
+        if cursor is not None:
+            i = max(i, bisect_right(names, cursor))
+        matched = []
+        while i < len(names) and names[i].startswith(prefix) and len(matched) < limit:
+            if fnmatchcase(names[i], pattern):
+                matched.append(names[i])
+            i += 1
+        more = i < len(names) and names[i].startswith(prefix)
+        return matched, names[i - 1] if more else None
+
+    @staticmethod
+    def __locate(record, include_md5, chunk_range):
+        merkle_root = record.get('merkle_root')
+        packed_md5s = record['chunk_md5s']
+        addresses = []
+        for address, holder in record['holders'].items():
+            chunkids = holder.iter_range(*chunk_range) if chunk_range else holder
+            if include_md5 and merkle_root is None:
+                chunks = [{ 'id': chunkid, 'md5': packed_md5s[chunkid * MD5_BYTES:(chunkid + 1) * MD5_BYTES].hex() } for chunkid in chunkids]
+            elif include_md5:
+                chunks = [{ 'id': chunkid } for chunkid in chunkids]
+            else:
+                chunks = list(chunkids)
+            if chunk_range and not chunks:
+                continue
+            addresses.append({
+                'host': address.split(':')[0],
+                'port': address.split(':')[1],
+                'chunks': chunks,
+            })
+        response = {
+            'bytes': record['bytes'],
+            'bytes_per_chunk': record['bytes_per_chunk'],
+            'num_chunks': record['num_chunks'],
+            'md5': record['md5'],
+            'hash': record['hash'],
+            'version': record['version'],
+            'count': len(addresses),
+            'addresses': addresses,
+        }
+        if merkle_root is not None:
+            response['merkle_root'] = merkle_root
+        return response
+
+    def handler_file_location_changes(self, args):
+        """
+        The changes to the holders of a file since a version returned by handler_file_locations or by this handler. Addresses in 'removed' have left; apply them before 'added'.
+
+        args = {
+            'address': '168.0.0.3:4444',
+            'filename': 'f1.txt',
+            'since': 7,
+            'wait': 10
+        }
+
+        returns: {
+            'version': 9,
+            'reset': False,
+            'added': {
+                '127.0.0.3:4321': [1, 2],
+            },
+            'removed': ['154.0.0.3:3333']
+        }
+
+        'reset' is True, with nothing else, when the changes are not known anymore. The caller then needs handler_file_locations again.
+
+        If nothing changed since 'since', the response is held back until something does, for up to 'wait' seconds (at most SUBSCRIBE_WAIT), and is empty if nothing did. Calling again with the version returned subscribes to the file: every change is sent once, as soon as it happens. When as many requests as the node lets wait (see Node._max_waiters) are waiting already, the response is sent right away.
+        """
+        wait = min(float(args.get('wait') or 0), protocol.SUBSCRIBE_WAIT)
+        if wait > 0 and not self.__waiters.acquire(blocking=False):
+            wait = 0
+        try:
+            changes = self.index.changes(args['filename'], args['since'], wait)
+        finally:
+            if wait > 0:
+                self.__waiters.release()
+        if changes is None:
+            return { 'reset': True }
+        version, entries = changes
+        added = {}
+        removed = []
+        for _, address, chunkid in entries:
+            if chunkid is None:
+                added.pop(address, None)
+                if address not in removed:
+                    removed.append(address)
+            else:
+                added.setdefault(address, []).append(chunkid)
+        return {
+            'version': version,
+            'reset': False,
+            'added': added,
+            'removed': removed,
         }
 
     def handler_register_chunk(self, args):
@@ -159,13 +371,30 @@ class Server(Node):
         chunkid = args['chunkid']
         md5 = args['md5']
         # if the server does not have this file, or the passed-in chunkid is invalid, or the passed-in md5 does not match the record, then return False. Otherwise, register.
-        if filename not in self.files or\
-                chunkid < 0 or\
-                chunkid >= len(self.files[filename]['chunks']) or\
-                self.files[filename]['chunks'][chunkid]['md5'] != md5:
-            return { 'result': False }
-        self.files[filename]['chunks'][chunkid]['peers'][address] = True
-        return { 'result': True }
+        result = self.index.add_chunk(filename, chunkid, md5, address)
+        self.__save()
+        return { 'result': result }
+
+    def handler_register_chunks(self, args):
+        """
+        Same as handler_register_chunk, for many chunks in one request
+
+        args = {
+            'address': '168.0.0.3:4444',
+            'chunks': [
+                ['f1.txt', 0, 'e22428ccf96cda9674a939c209ad1000'],
+                ['f1.txt', 1, '03c7c0ace395d80182db07ae2c30f034']
+            ]
+        }
+
+        returns {
+            'result': [True, False]
+        }
+        """
+        address = args['address']
+        result = [self.index.add_chunk(filename, chunkid, md5, address) for filename, chunkid, md5 in args['chunks']]
+        self.__save()
+        return { 'result': result }
 
     def handler_leave(self, args):
         """
@@ -173,18 +402,26 @@ class Server(Node):
             'address': '168.0.0.3:4444'
         }
         """
-        address = args['address']
-        filenames_to_be_deleted = []
-        for filename in self.files:
-            for chunk in self.files[filename]['chunks']:
-                if address in chunk['peers']:
-                    if len(chunk['peers']) == 0:
-                        filenames_to_be_deleted.append(filename)
-                    chunk['peers'].pop(address)
-        for filename in filenames_to_be_deleted:
-            self.files.pop(filename)
+        # Files that nobody holds anymore are dropped from the network
+        self.index.remove_peer(args['address'])
+        self.__save()
         return { 'result': True }
 
+    def __save(self):
+        """
+        Write out what the last request changed, and start a new snapshot in the background once the log has grown long enough
+        """
+        if self.store is None:
+            return
+        self.store.flush()
+        if self.store.num_records < protocol.TRACKER_SNAPSHOT_RECORDS:
+            return
+        with self.__snapshot_lock:
+            if self.__snapshot_thread and self.__snapshot_thread.is_alive():
+                return
+            self.__snapshot_thread = Thread(target=self.store.snapshot, args=(self.index,), name='{}-snapshot'.format(self.name))
+            self.__snapshot_thread.start()
+
     def run(self):
         t = Thread(target=self.listen)
         t.start()
@@ -197,6 +434,8 @@ if __name__ == '__main__':
     parser.add_argument('-H', '--host', required=True)
     parser.add_argument('-p', '--port', required=True)
     parser.add_argument('-dpr', '--dynamic_port_range', required=True)
+    parser.add_argument('-e', '--engine', choices=protocol.ENGINES, default='thread', help='"thread" serves each connection on its own thread, "asyncio" serves all connections from one event loop')
+    parser.add_argument('-d', '--data_dir', help='directory to keep the registrations in across restarts. Without it they are kept in memory only')
     args = parser.parse_args()
-    server = Server(host=args.host, port=args.port, dynamic_port_range=args.dynamic_port_range)
+    server = Server(host=args.host, port=args.port, dynamic_port_range=args.dynamic_port_range, engine=args.engine, data_dir=args.data_dir)
     server.run()
@@ -0,0 +1,298 @@
+import re
+from collections import deque
+from itertools import count, islice
+from threading import Condition, Lock
+
+import hashing
+import protocol
+from bitfield import Bitfield
+
+MD5_BYTES = hashing.DIGEST_BYTES
+DIGEST_PATTERN = re.compile('[0-9a-f]{{{}}}'.format(2 * MD5_BYTES))
+
+
+def is_digest(value):
+    """
+    Whether `value` is a digest as peers send them: MD5_BYTES in lowercase hex
+    """
+    return isinstance(value, str) and DIGEST_PATTERN.fullmatch(value) is not None
+
+
+def is_size(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+class TrackerShard:
+    """
+    The files whose names hash to one shard, the reverse index of which peers hold them, and the lock that guards both. `changed` is notified, under the lock, whenever the holders of a file of the shard change
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.peers = {}
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+
+
+class TrackerIndex:
+    """
+    Storage engine of the tracker. It is safe to use from any number of threads.
+
+    Files are spread over TRACKER_SHARDS shards by the hash of their name, and each shard has its own lock, so requests about different files rarely wait for each other. Everything about one file is changed under the lock of its shard, and what is read out (get_file, changes, list_files) is copied under it, so nothing is ever iterated while it changes. Leaving a peer goes through the shards one at a time.
+
+    Chunk ownership is kept per peer per file as a Bitfield, and a reverse index in every shard maps every peer to the files of that shard it holds chunks of. Registering a chunk, locating a file and removing a peer therefore cost time proportional to what that file or that peer holds, not to the whole swarm. Chunk md5s are packed into one bytes object per file. Whatever algorithm ('hash') a file was registered with, its 'md5' fields hold digests of that algorithm, all of MD5_BYTES.
+
+    Every change to the holders of a file bumps its version and is appended to its change log, so that downloaders can ask what changed since the version they know (see changes). The log keeps the last TRACKER_CHANGE_LOG_LENGTH changes of each file.
+
+    self.shards[i].files = {
+        'f1.txt': {
+            'bytes': 2048,
+            'bytes_per_chunk': 1024,
+            'md5': '03c7c0ace395d80182db07ae2c30f034',
+            'hash': 'md5',
+            'num_chunks': 2,
+            'chunk_md5s': b'...',   # 16 bytes per chunk, chunk 0 first. Empty for files registered by their Merkle root
+            'merkle_root': None,    # hex root of the hash tree over the chunk md5s, in place of chunk_md5s
+            'holders': {
+                '168.0.0.1:4444': Bitfield(2/2),
+                '153.43.44.2:5311': Bitfield(1/2),
+            },
+            'version': 2,
+            'serial': 17,           # tells this registration of the file from earlier ones of the same name, which start over at version 0
+            'changes': deque([
+                (1, '153.43.44.2:5311', 0),     # chunk 0 registered
+                (2, '10.0.0.7:2000', None),     # peer left
+            ]),
+        }
+    }
+
+    self.shards[i].peers = {
+        '168.0.0.1:4444': {'f1.txt'},
+        '153.43.44.2:5311': {'f1.txt'},
+    }
+    """
+
+    def __init__(self, journal=None, num_shards=protocol.TRACKER_SHARDS):
+        self.shards = [TrackerShard() for _ in range(num_shards)]
+        # A TrackerStore that every change is logged to, or None. Changes are logged under the lock of their shard, so the log has them in the order they happened to each file
+        self.journal = journal
+        self.__serials = count()
+        # Moves forward whenever a file is added or removed, i.e. whenever list_files would return something else
+        self.catalog_version = 0
+        self.__catalog_lock = Lock()
+
+    def shard(self, filename):
+        return self.shards[hash(filename) % len(self.shards)]
+
+    def add_file(self, filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, address, merkle_root=None, num_chunks=None, algorithm=hashing.DEFAULT_ALGORITHM):
+        """
+        Register a file held in full by `address`. Returns False if a file of that name is already registered.
+
+        A file is registered either with the md5 of every chunk, or with the `merkle_root` of its hash tree and its `num_chunks`, in which case `chunk_md5s` is empty. The record is checked before anything is stored or logged, and False is returned if a digest is not MD5_BYTES of hex or the number of chunks does not match the size of the file, since snapshots and logs are read back by those sizes.
+        """
+        if not self.__valid_file(file_bytes, bytes_per_chunk, md5, chunk_md5s, merkle_root, num_chunks):
+            return False
+        packed_md5s = b''.join(bytes.fromhex(chunk_md5) for chunk_md5 in chunk_md5s)
+        if num_chunks is None:
+            num_chunks = len(chunk_md5s)
+        shard = self.shard(filename)
+        with shard.lock:
+            if not self.__load_file(shard, filename, file_bytes, bytes_per_chunk, md5, packed_md5s, { address: Bitfield.full(num_chunks) }, 0, num_chunks, merkle_root, algorithm):
+                return False
+            if self.journal:
+                self.journal.log_add_file(filename, file_bytes, bytes_per_chunk, md5, packed_md5s, address, merkle_root, num_chunks, algorithm)
+        return True
+
+    @staticmethod
+    def __valid_file(file_bytes, bytes_per_chunk, md5, chunk_md5s, merkle_root, num_chunks):
+        if not is_size(file_bytes) or not is_size(bytes_per_chunk) or bytes_per_chunk == 0 or not is_digest(md5):
+            return False
+        expected_chunks = (file_bytes + bytes_per_chunk - 1) // bytes_per_chunk
+        if merkle_root is not None:
+            return is_digest(merkle_root) and not chunk_md5s and num_chunks == expected_chunks
+        if not isinstance(chunk_md5s, list) or not all(is_digest(chunk_md5) for chunk_md5 in chunk_md5s):
+            return False
+        return len(chunk_md5s) == expected_chunks and num_chunks in (None, expected_chunks)
+
+    def load_file(self, filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, holders, version=0, num_chunks=None, merkle_root=None, algorithm=hashing.DEFAULT_ALGORITHM):
+        """
+        Put a file record in as it is, e.g. from a snapshot. `chunk_md5s` are packed and `holders` maps addresses to Bitfields. Nothing is logged. Returns False if a file of that name is already registered.
+        """
+        shard = self.shard(filename)
+        with shard.lock:
+            return self.__load_file(shard, filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, holders, version, num_chunks, merkle_root, algorithm)
+
+    def __load_file(self, shard, filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, holders, version, num_chunks, merkle_root, algorithm):
+        if filename in shard.files:
+            return False
+        self.__catalog_changed()
+        shard.files[filename] = {
+            'bytes': file_bytes,
+            'bytes_per_chunk': bytes_per_chunk,
+            'md5': md5,
+            'hash': algorithm,
+            'num_chunks': num_chunks if num_chunks is not None else len(chunk_md5s) // MD5_BYTES,
+            'chunk_md5s': chunk_md5s,
+            'merkle_root': merkle_root,
+            'holders': holders,
+            'version': version,
+            'serial': next(self.__serials),
+            'changes': deque(maxlen=protocol.TRACKER_CHANGE_LOG_LENGTH),
+        }
+        for address in holders:
+            shard.peers.setdefault(address, set()).add(filename)
+        return True
+
+    def add_chunk(self, filename, chunkid, md5, address):
+        """
+        Record that `address` holds a chunk. Returns False if the file is unknown, the chunk id is out of range or the md5 does not match the record. Files registered by their Merkle root have no chunk md5s to check against; their chunks were checked by the peer against the root.
+        """
+        shard = self.shard(filename)
+        with shard.lock:
+            record = shard.files.get(filename)
+            if record is None or chunkid < 0 or chunkid >= record['num_chunks']:
+                return False
+            if record['chunk_md5s'] and self.__chunk_md5(record, chunkid) != md5:
+                return False
+            holder = record['holders'].get(address)
+            if holder is None:
+                holder = record['holders'][address] = Bitfield(record['num_chunks'])
+                shard.peers.setdefault(address, set()).add(filename)
+            if holder.add(chunkid):
+                self.__log_change(record, address, chunkid)
+                shard.changed.notify_all()
+                if self.journal:
+                    self.journal.log_add_chunk(filename, chunkid, address)
+        return True
+
+    def remove_peer(self, address):
+        """
+        Forget everything `address` holds. Files nobody holds any chunk of anymore are removed. Returns the names of removed files.
+        """
+        removed = []
+        for shard in self.shards:
+            with shard.lock:
+                filenames = shard.peers.pop(address, None)
+                if filenames is None:
+                    continue
+                # Logged per shard, with the files of that shard only: chunks the peer registers in a shard that is not walked yet come after the removal and must survive a replay of it
+                if self.journal:
+                    self.journal.log_remove_holder(address, sorted(filenames))
+                self.__drop_holder(shard, address, filenames, removed)
+        return removed
+
+    def remove_holder(self, address, filenames):
+        """
+        Forget that `address` holds any chunk of `filenames`, as remove_peer does shard by shard. Nothing is logged. Returns the names of removed files.
+        """
+        removed = []
+        for filename in filenames:
+            shard = self.shard(filename)
+            with shard.lock:
+                held = shard.peers.get(address)
+                if held is None or filename not in held:
+                    continue
+                held.discard(filename)
+                if not held:
+                    shard.peers.pop(address)
+                self.__drop_holder(shard, address, [filename], removed)
+        return removed
+
+    def __drop_holder(self, shard, address, filenames, removed):
+        for filename in filenames:
+            record = shard.files[filename]
+            record['holders'].pop(address, None)
+            if not record['holders']:
+                shard.files.pop(filename)
+                removed.append(filename)
+                self.__catalog_changed()
+            else:
+                self.__log_change(record, address, None)
+        shard.changed.notify_all()
+
+    def get_file(self, filename):
+        """
+        A copy of the record of a file, without its change log, that can be read while the index keeps changing. None if the file is unknown.
+        """
+        shard = self.shard(filename)
+        with shard.lock:
+            record = shard.files.get(filename)
+            if record is None:
+                return None
+            copy = { key: value for key, value in record.items() if key not in ('holders', 'changes') }
+            copy['holders'] = { address: holder.copy() for address, holder in record['holders'].items() }
+            return copy
+
+    def file_version(self, filename):
+        """
+        @return (serial, version) of a file, which changes whenever anything get_file returns does, or None if the file is unknown
+        """
+        shard = self.shard(filename)
+        with shard.lock:
+            record = shard.files.get(filename)
+            if record is None:
+                return None
+            return record['serial'], record['version']
+
+    def chunk_md5(self, filename, chunkid):
+        """
+        @return the md5 of a chunk, or None if the file is unknown or has no chunk md5s
+        """
+        shard = self.shard(filename)
+        with shard.lock:
+            record = shard.files.get(filename)
+            if record is None or not record['chunk_md5s']:
+                return None
+            return self.__chunk_md5(record, chunkid)
+
+    @staticmethod
+    def __chunk_md5(record, chunkid):
+        return record['chunk_md5s'][chunkid * MD5_BYTES:(chunkid + 1) * MD5_BYTES].hex()
+
+    def set_hash(self, filename, algorithm):
+        shard = self.shard(filename)
+        with shard.lock:
+            record = shard.files.get(filename)
+            if record is not None:
+                record['hash'] = algorithm
+
+    def num_files(self):
+        return sum(len(shard.files) for shard in self.shards)
+
+    def changes(self, filename, since, timeout=0):
+        """
+        What happened to the holders of a file after version `since`, oldest first, as (version, address, chunkid) with chunkid None when the peer left. If nothing did yet, wait up to `timeout` seconds for something to happen; the changes are then empty if nothing did.
+
+        @return the current version and the changes, or None if the file is unknown or the log does not go back to `since`
+        """
+        shard = self.shard(filename)
+        with shard.lock:
+            record = shard.files.get(filename)
+            if timeout > 0 and record is not None and record['version'] == since:
+                # The file may also be removed, or removed and registered again, meanwhile
+                shard.changed.wait_for(lambda: shard.files.get(filename) is not record or record['version'] != since, timeout)
+                record = shard.files.get(filename)
+            if record is None or since > record['version']:
+                return None
+            num_changes = record['version'] - since
+            if num_changes > len(record['changes']):
+                return None
+            return record['version'], list(islice(record['changes'], len(record['changes']) - num_changes, None))
+
+    def __log_change(self, record, address, chunkid):
+        record['version'] += 1
+        record['changes'].append((record['version'], address, chunkid))
+
+    def __catalog_changed(self):
+        with self.__catalog_lock:
+            self.catalog_version += 1
+
+    def list_files(self):
+        """
+        @return (filename, bytes) of every file, in no particular order
+        """
+        files = []
+        for shard in self.shards:
+            with shard.lock:
+                files.extend((filename, record['bytes']) for filename, record in shard.files.items())
+        return files
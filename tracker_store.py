@@ -0,0 +1,315 @@
+import os
+import shutil
+from os.path import join
+from struct import Struct
+from threading import Lock
+
+import hashing
+from bitfield import Bitfield
+from tracker import MD5_BYTES
+
+SNAPSHOT_FILENAME = 'tracker.snapshot'
+LOG_FILENAME = 'tracker.log'
+# The log records a snapshot being written covers, until it is complete
+OLD_LOG_FILENAME = 'tracker.log.old'
+SNAPSHOT_MAGIC = b'TRK2'
+# Snapshots written before files could be registered by a Merkle root
+SNAPSHOT_MAGIC_V1 = b'TRK1'
+
+# name length, bytes, bytes per chunk, number of chunks, number of holders, version, flags: SNAPSHOT_FLAG_MERKLE, and the id of the hash algorithm shifted by SNAPSHOT_HASH_SHIFT
+SNAPSHOT_FILE = Struct('!HQIIIQB')
+# A Merkle root follows the file md5 in place of the chunk md5s
+SNAPSHOT_FLAG_MERKLE = 0x01
+SNAPSHOT_HASH_SHIFT = 1
+SNAPSHOT_FILE_V1 = Struct('!HQIIIQ')
+# address length
+SNAPSHOT_HOLDER = Struct('!H')
+# record type, payload length
+LOG_RECORD = Struct('!BI')
+# bytes, bytes per chunk, name length, address length
+LOG_ADD_FILE = Struct('!QIHH')
+# bytes, bytes per chunk, number of chunks, name length, address length
+LOG_ADD_MERKLE_FILE = Struct('!QIIHH')
+# chunk id, name length, address length
+LOG_ADD_CHUNK = Struct('!IHH')
+# hash algorithm id, followed by the name
+LOG_FILE_HASH = Struct('!B')
+# address length, number of files, followed by the address and by every name with its length
+LOG_REMOVE_HOLDER = Struct('!HI')
+LOG_NAME = Struct('!H')
+
+LOG_TYPES = {
+    'add_file': 1,
+    'add_chunk': 2,
+    'remove_peer': 3,
+    'add_merkle_file': 4,
+    # Follows the add_file / add_merkle_file of a file not hashed with md5
+    'file_hash': 5,
+    # A peer removed from the files of one shard. Logs written before it have 'remove_peer', which removes the peer from every file
+    'remove_holder': 6,
+}
+
+ID_TO_ALGORITHM = {algorithm_id: algorithm for algorithm, algorithm_id in hashing.ALGORITHM_IDS.items()}
+
+
+class TrackerStore:
+    """
+    Keeps a TrackerIndex on disk, in `directory`, as a snapshot plus an append-only log of everything that changed since.
+
+    The snapshot is a binary table: per file a fixed header, the name, the file md5 and the packed chunk md5s as they are in memory (or the Merkle root in their place), then every holder with its bitfield. Loading it is a matter of slicing one buffer. The log has one binary record per add_file / add_chunk call and per shard a remove_peer call went through, and is replayed on top of the snapshot. Replaying a record the snapshot already covers changes nothing, so a snapshot can be written while the index keeps changing.
+
+    Records are buffered and written out by flush(). A record cut short by a crash is ignored on load.
+
+    Writing a snapshot first moves the log aside and starts a new one, then copies the index shard by shard under each shard's lock. The store's own lock is never held while a shard lock is taken, since the index logs while holding its shard locks.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__snapshot_path = join(directory, SNAPSHOT_FILENAME)
+        self.__log_path = join(directory, LOG_FILENAME)
+        self.__old_log_path = join(directory, OLD_LOG_FILENAME)
+        self.__lock = Lock()
+        # Held while a snapshot is being written, so that only one is
+        self.__snapshot_lock = Lock()
+        self.__log = None
+        self.num_records = 0
+
+    def load(self, index):
+        """
+        Fill an empty index from the snapshot and the log, then start logging.
+
+        @return the number of files loaded
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.__snapshot_path):
+            with open(self.__snapshot_path, 'rb') as f:
+                self.__load_snapshot(index, f.read())
+        # Left by a crash while a snapshot was being written: its records come before those of the current log
+        unfinished_snapshot = os.path.exists(self.__old_log_path)
+        if unfinished_snapshot:
+            with open(self.__old_log_path, 'rb') as f:
+                self.__replay_log(index, f.read())
+        if os.path.exists(self.__log_path):
+            with open(self.__log_path, 'rb') as f:
+                self.num_records, length = self.__replay_log(index, f.read())
+            # Drop a record cut short by a crash, so that new records are not appended after it
+            os.truncate(self.__log_path, length)
+        # Changes made before the restart are not in the change logs anymore. Moving every version forward makes 'loc_delta' callers start over from 'loc'
+        for shard in index.shards:
+            with shard.lock:
+                for record in shard.files.values():
+                    record['version'] += 1
+        self.__log = open(self.__log_path, 'ab')
+        if unfinished_snapshot:
+            self.snapshot(index)
+        return index.num_files()
+
+    def log_add_file(self, filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, address, merkle_root=None, num_chunks=None, algorithm=hashing.DEFAULT_ALGORITHM):
+        """
+        @param md5: type str, hex
+        @param chunk_md5s: type bytes, packed as in the index
+        @param merkle_root: type str, hex, for files registered by their Merkle root instead of chunk md5s
+        """
+        name = filename.encode('utf-8')
+        encoded_address = address.encode('utf-8')
+        if merkle_root is not None:
+            self.__append('add_merkle_file', b''.join([
+                LOG_ADD_MERKLE_FILE.pack(file_bytes, bytes_per_chunk, num_chunks, len(name), len(encoded_address)),
+                name,
+                encoded_address,
+                bytes.fromhex(md5),
+                bytes.fromhex(merkle_root),
+            ]))
+        else:
+            self.__append('add_file', b''.join([
+                LOG_ADD_FILE.pack(file_bytes, bytes_per_chunk, len(name), len(encoded_address)),
+                name,
+                encoded_address,
+                bytes.fromhex(md5),
+                chunk_md5s,
+            ]))
+        if algorithm != hashing.DEFAULT_ALGORITHM:
+            self.__append('file_hash', LOG_FILE_HASH.pack(hashing.ALGORITHM_IDS[algorithm]) + name)
+
+    def log_add_chunk(self, filename, chunkid, address):
+        name = filename.encode('utf-8')
+        address = address.encode('utf-8')
+        self.__append('add_chunk', LOG_ADD_CHUNK.pack(chunkid, len(name), len(address)) + name + address)
+
+    def log_remove_holder(self, address, filenames):
+        address = address.encode('utf-8')
+        parts = [LOG_REMOVE_HOLDER.pack(len(address), len(filenames)), address]
+        for filename in filenames:
+            name = filename.encode('utf-8')
+            parts.append(LOG_NAME.pack(len(name)))
+            parts.append(name)
+        self.__append('remove_holder', b''.join(parts))
+
+    def flush(self):
+        with self.__lock:
+            if self.__log:
+                self.__log.flush()
+
+    def snapshot(self, index):
+        """
+        Write the whole index to a new snapshot and start the log over. The snapshot replaces the previous one only once it is complete on disk; until then the log it covers is kept. Does nothing if another thread is writing a snapshot already.
+        """
+        if not self.__snapshot_lock.acquire(blocking=False):
+            return
+        try:
+            with self.__lock:
+                if self.__log:
+                    self.__log.close()
+                if os.path.exists(self.__old_log_path):
+                    with open(self.__old_log_path, 'ab') as old_log, open(self.__log_path, 'rb') as log:
+                        shutil.copyfileobj(log, old_log)
+                elif os.path.exists(self.__log_path):
+                    os.replace(self.__log_path, self.__old_log_path)
+                self.__log = open(self.__log_path, 'wb')
+                self.num_records = 0
+
+            tmp_path = self.__snapshot_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                for shard in index.shards:
+                    with shard.lock:
+                        data = b''.join(self.__pack_file(filename, record) for filename, record in shard.files.items())
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.__snapshot_path)
+            if os.path.exists(self.__old_log_path):
+                os.remove(self.__old_log_path)
+        finally:
+            self.__snapshot_lock.release()
+
+    @staticmethod
+    def __pack_file(filename, record):
+        name = filename.encode('utf-8')
+        merkle_root = record.get('merkle_root')
+        flags = hashing.ALGORITHM_IDS[record['hash']] << SNAPSHOT_HASH_SHIFT
+        if merkle_root is not None:
+            flags |= SNAPSHOT_FLAG_MERKLE
+        parts = [
+            SNAPSHOT_FILE.pack(len(name), record['bytes'], record['bytes_per_chunk'], record['num_chunks'], len(record['holders']), record['version'], flags),
+            name,
+            bytes.fromhex(record['md5']),
+            bytes.fromhex(merkle_root) if merkle_root is not None else record['chunk_md5s'],
+        ]
+        for address, holder in record['holders'].items():
+            address = address.encode('utf-8')
+            parts.append(SNAPSHOT_HOLDER.pack(len(address)))
+            parts.append(address)
+            parts.append(holder.to_bytes())
+        return b''.join(parts)
+
+    def close(self):
+        with self.__lock:
+            if self.__log:
+                self.__log.close()
+                self.__log = None
+
+    def __append(self, log_type, payload):
+        with self.__lock:
+            if self.__log is None:
+                return
+            self.__log.write(LOG_RECORD.pack(LOG_TYPES[log_type], len(payload)))
+            self.__log.write(payload)
+            self.num_records += 1
+
+    @staticmethod
+    def __load_snapshot(index, data):
+        magic = data[:len(SNAPSHOT_MAGIC)]
+        if magic not in (SNAPSHOT_MAGIC, SNAPSHOT_MAGIC_V1):
+            raise ValueError('Not a tracker snapshot')
+        header = SNAPSHOT_FILE if magic == SNAPSHOT_MAGIC else SNAPSHOT_FILE_V1
+        view = memoryview(data)
+        offset = len(SNAPSHOT_MAGIC)
+        while offset < len(data):
+            name_length, file_bytes, bytes_per_chunk, num_chunks, num_holders, version, *flags = header.unpack_from(data, offset)
+            flags = flags[0] if flags else 0
+            offset += header.size
+            filename = str(view[offset:offset + name_length], 'utf-8')
+            offset += name_length
+            md5 = view[offset:offset + MD5_BYTES].hex()
+            offset += MD5_BYTES
+            merkle_root = None
+            chunk_md5s = b''
+            if flags & SNAPSHOT_FLAG_MERKLE:
+                merkle_root = view[offset:offset + MD5_BYTES].hex()
+                offset += MD5_BYTES
+            else:
+                chunk_md5s = bytes(view[offset:offset + num_chunks * MD5_BYTES])
+                offset += num_chunks * MD5_BYTES
+            bitfield_bytes = (num_chunks + 7) // 8
+            holders = {}
+            for _ in range(num_holders):
+                address_length, = SNAPSHOT_HOLDER.unpack_from(data, offset)
+                offset += SNAPSHOT_HOLDER.size
+                address = str(view[offset:offset + address_length], 'utf-8')
+                offset += address_length
+                holders[address] = Bitfield.from_bytes(num_chunks, view[offset:offset + bitfield_bytes])
+                offset += bitfield_bytes
+            index.load_file(filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, holders, version, num_chunks, merkle_root, ID_TO_ALGORITHM[flags >> SNAPSHOT_HASH_SHIFT])
+
+    @staticmethod
+    def __replay_log(index, data):
+        view = memoryview(data)
+        offset = 0
+        num_records = 0
+        while offset + LOG_RECORD.size <= len(data):
+            log_type, length = LOG_RECORD.unpack_from(data, offset)
+            if offset + LOG_RECORD.size + length > len(data):
+                break
+            offset += LOG_RECORD.size
+            payload = view[offset:offset + length]
+            offset += length
+            num_records += 1
+            if log_type == LOG_TYPES['add_file']:
+                file_bytes, bytes_per_chunk, name_length, address_length = LOG_ADD_FILE.unpack_from(payload)
+                position = LOG_ADD_FILE.size
+                filename = str(payload[position:position + name_length], 'utf-8')
+                position += name_length
+                address = str(payload[position:position + address_length], 'utf-8')
+                position += address_length
+                md5 = payload[position:position + MD5_BYTES].hex()
+                position += MD5_BYTES
+                chunk_md5s = bytes(payload[position:])
+                index.load_file(filename, file_bytes, bytes_per_chunk, md5, chunk_md5s, { address: Bitfield.full(len(chunk_md5s) // MD5_BYTES) })
+            elif log_type == LOG_TYPES['add_merkle_file']:
+                file_bytes, bytes_per_chunk, num_chunks, name_length, address_length = LOG_ADD_MERKLE_FILE.unpack_from(payload)
+                position = LOG_ADD_MERKLE_FILE.size
+                filename = str(payload[position:position + name_length], 'utf-8')
+                position += name_length
+                address = str(payload[position:position + address_length], 'utf-8')
+                position += address_length
+                md5 = payload[position:position + MD5_BYTES].hex()
+                position += MD5_BYTES
+                merkle_root = payload[position:position + MD5_BYTES].hex()
+                index.load_file(filename, file_bytes, bytes_per_chunk, md5, b'', { address: Bitfield.full(num_chunks) }, num_chunks=num_chunks, merkle_root=merkle_root)
+            elif log_type == LOG_TYPES['add_chunk']:
+                chunkid, name_length, address_length = LOG_ADD_CHUNK.unpack_from(payload)
+                position = LOG_ADD_CHUNK.size
+                filename = str(payload[position:position + name_length], 'utf-8')
+                position += name_length
+                address = str(payload[position:position + address_length], 'utf-8')
+                # Checked when it was logged
+                index.add_chunk(filename, chunkid, index.chunk_md5(filename, chunkid), address)
+            elif log_type == LOG_TYPES['file_hash']:
+                algorithm_id, = LOG_FILE_HASH.unpack_from(payload)
+                index.set_hash(str(payload[LOG_FILE_HASH.size:], 'utf-8'), ID_TO_ALGORITHM[algorithm_id])
+            elif log_type == LOG_TYPES['remove_peer']:
+                index.remove_peer(str(payload, 'utf-8'))
+            elif log_type == LOG_TYPES['remove_holder']:
+                address_length, num_files = LOG_REMOVE_HOLDER.unpack_from(payload)
+                position = LOG_REMOVE_HOLDER.size
+                address = str(payload[position:position + address_length], 'utf-8')
+                position += address_length
+                filenames = []
+                for _ in range(num_files):
+                    name_length, = LOG_NAME.unpack_from(payload, position)
+                    position += LOG_NAME.size
+                    filenames.append(str(payload[position:position + name_length], 'utf-8'))
+                    position += name_length
+                index.remove_holder(address, filenames)
+        return num_records, offset
@@ -1,6 +1,7 @@
 from queue import Empty
-from threading import Thread, Event
-from time import sleep
+from threading import Thread, Event, Lock
+from time import sleep, time
+import protocol
 from protocol import DownloadFail
 
 
@@ -21,26 +22,39 @@ class Worker(Thread):
 
 
 class QueueWorker(Worker):
-    def __init__(self, handler, logger, task_queue, watcher, name=None):
+    """
+    Runs the handler on tasks from the queue. Without an `idle_handler` the worker stops once the queue stays empty. With one, the worker calls it whenever the queue is empty and keeps going until its shutdown flag is set. The idle handler returns None when it had nothing to do or what it tried failed, in which case the worker waits up to WORKER_POLL_INTERVAL for a task before calling it again.
+    """
+
+    def __init__(self, handler, logger, task_queue, watcher, name=None, idle_handler=None):
         super().__init__(handler, logger, name)
         self.__task_queue = task_queue
         self.__watcher = watcher
+        self.__idle_handler = idle_handler
 
     def run(self):
         self._logger.info('QueueWorker {} started'.format(self._name))
+        timeout = protocol.WORKER_POLL_INTERVAL if self.__idle_handler else 1
+        wait = True
         while not self.shutdown_flag.is_set():
             try:
-                task = self.__task_queue.get(timeout=1)
-                if not task:
-                    break
-                result = self._handler(self.__task_queue, task)
-                if result:
-                    self.__watcher.data.append(result)
+                try:
+                    task = self.__task_queue.get(block=wait, timeout=timeout)
+                except Empty:
+                    if not self.__idle_handler:
+                        break
+                    results = self.__idle_handler()
+                    wait = results is None
+                else:
+                    wait = True
+                    if not task:
+                        break
+                    results = self._handler(self.__task_queue, task)
+                if results:
+                    self.__watcher.data.extend(results)
             except DownloadFail:
                 self.__watcher.shutdown_flag.set()
                 break
-            except Empty:
-                break
         self._logger.info('QueueWorker {} stopped'.format(self._name))
 
 
@@ -58,3 +72,73 @@ class Watcher(Worker):
                 self.__routine_function(self)
         self.__fail_handler()
         self._logger.info('Watcher {} stopped'.format(self._name))
+
+
+class Announcer(Worker):
+    """
+    Collects announcements and hands them to the handler in batches: as soon as `batch_size` of them are waiting, or every `interval` seconds otherwise. The handler runs on this thread, so callers of announce() never wait on the network.
+    """
+
+    def __init__(self, handler, logger, batch_size, interval):
+        super().__init__(handler, logger, 'announcer')
+        self.daemon = True
+        self.__batch_size = batch_size
+        self.__interval = interval
+        self.__items = []
+        self.__lock = Lock()
+        self.__wakeup = Event()
+
+    def announce(self, item):
+        with self.__lock:
+            self.__items.append(item)
+            full = len(self.__items) >= self.__batch_size
+        if full:
+            self.__wakeup.set()
+
+    def flush(self):
+        """
+        Hand every waiting announcement to the handler. If the handler fails, the announcements it did not take are put back to be tried again on the next flush, and the error is logged rather than raised, so it is safe to call from any thread.
+
+        @return True if nothing is left waiting from before the call
+        """
+        with self.__lock:
+            items, self.__items = self.__items, []
+        for i in range(0, len(items), self.__batch_size):
+            try:
+                self._handler(items[i:i + self.__batch_size])
+            except Exception as e:
+                self._logger.error('Fail to announce, {} announcements are kept for later: {}'.format(len(items) - i, e))
+                with self.__lock:
+                    self.__items[:0] = items[i:]
+                return False
+        return True
+
+    def run(self):
+        self._logger.info('Announcer {} started'.format(self._name))
+        while not self.shutdown_flag.is_set():
+            self.__wakeup.wait(self.__interval)
+            self.__wakeup.clear()
+            self.flush()
+        self._logger.info('Announcer {} stopped'.format(self._name))
+
+
+class Poller(Worker):
+    """
+    Calls the handler over and over until the shutdown flag is set, at most once every `interval` seconds. The handler may block until there is something new, e.g. on a long poll. Errors are logged and the handler is called again after `interval`. The thread is a daemon: it may be left waiting in the handler when it is shut down.
+    """
+
+    def __init__(self, handler, logger, interval, name=None):
+        super().__init__(handler, logger, name)
+        self.daemon = True
+        self.__interval = interval
+
+    def run(self):
+        self._logger.info('Poller {} started'.format(self._name))
+        while not self.shutdown_flag.is_set():
+            started_at = time()
+            try:
+                self._handler()
+            except Exception as e:
+                self._logger.warning('Poller {} failed: {}'.format(self._name, e))
+            self.shutdown_flag.wait(max(0, self.__interval - (time() - started_at)))
+        self._logger.info('Poller {} stopped'.format(self._name))